@@ -0,0 +1,265 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+from collections import defaultdict
+
+import main
+
+# Offline benchmark for the non-LLM overhead of run_main_loop.
+# completion() is replaced by a scripted stand-in, so every millisecond measured
+# here is spent in the agent loop itself rather than waiting on a provider.
+
+SCENARIOS = [10, 50, 500]
+PHASES = ["llm_wait", "context", "tools", "logging", "progress"]
+
+def synthetic_script(iterations, files_per_iteration=3, file_bytes=2000):
+    script = []
+    body = ("x = 1\n" * (file_bytes // 6 + 1))[:file_bytes]
+    for i in range(iterations - 1):
+        tool_calls = []
+        for j in range(files_per_iteration):
+            tool_calls.append({
+                "name": "create_file",
+                "arguments": {"path": f"{{project_dir}}/module_{i}_{j}.py", "content": body}
+            })
+        script.append({"content": f"Writing modules for step {i + 1}.", "tool_calls": tool_calls})
+    script.append({"content": "Done.", "tool_calls": [{"name": "task_completed", "arguments": {}}]})
+    return script
+
+def script_from_log(path, file_bytes=2000):
+    # Legacy flask_app_builder_log.json files and JSONL build logs only keep tool results,
+    # so the tool call arguments are reconstructed from them with synthetic file bodies.
+    if path.endswith(".jsonl"):
+        history_dict = main.read_build_log(path)
+    else:
+        with open(path, 'r') as log_file:
+            history_dict = json.load(log_file)
+    body = "x" * file_bytes
+    script = []
+    for iteration in history_dict.get("iterations", []):
+        tool_calls = []
+        for result in iteration.get("tool_results", []):
+            name = result.get("tool")
+            text = str(result.get("result") or "")
+            target = text.split(": ", 1)[1] if ": " in text else ""
+            target = "{project_dir}/" + os.path.basename(target) if target else "{project_dir}/file.txt"
+            if name in ("create_file", "update_file"):
+                tool_calls.append({"name": name, "arguments": {"path": target, "content": body}})
+            elif name == "create_directory":
+                tool_calls.append({"name": name, "arguments": {"path": target}})
+            elif name == "fetch_code":
+                tool_calls.append({"name": name, "arguments": {"file_path": target}})
+            elif name == "task_completed":
+                tool_calls.append({"name": name, "arguments": {}})
+        responses = iteration.get("llm_responses") or [""]
+        script.append({"content": responses[0], "tool_calls": tool_calls})
+    return script
+
+def script_from_cache(directory):
+    # Responses recorded with LLM_CACHE=record, replayed in the order they were written
+    entries = sorted(main.ResponseCache(directory).entries())
+    script = []
+    for _, _, path in entries:
+        with open(path, 'r') as cache_file:
+            script.append({"response": json.load(cache_file)})
+    return script
+
+class ScriptedLLM:
+    def __init__(self, script, project_dir, latency=0.0):
+        self.script = script
+        self.project_dir = project_dir
+        self.latency = latency
+        self.calls = 0
+
+    def __call__(self, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        step = self.script[min(self.calls, len(self.script) - 1)]
+        self.calls += 1
+        if "response" in step:
+            return main.model_response(**step["response"])
+        tool_calls = []
+        for index, call in enumerate(step["tool_calls"]):
+            arguments = json.dumps(call["arguments"]).replace("{project_dir}", self.project_dir)
+            tool_calls.append({
+                "id": f"call_{self.calls}_{index}",
+                "type": "function",
+                "function": {"name": call["name"], "arguments": arguments}
+            })
+        message = {"role": "assistant", "content": step["content"], "tool_calls": tool_calls or None}
+        return main.model_response(
+            choices=[{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_calls else "stop"}],
+            model=kwargs.get("model"),
+            usage={"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        )
+
+class PhaseTimer:
+    def __init__(self):
+        self.totals = defaultdict(lambda: defaultdict(float))
+
+    def wrap(self, phase, function):
+        def timed(*args, **kwargs):
+            job = main.current_job.get()
+            iteration = job.progress["iteration"] if job is not None else 0
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.totals[iteration][phase] += time.perf_counter() - start
+        return timed
+
+def measure_messages(function, sizes):
+    # Sits outside the timed wrapper so serialising the messages is not counted as overhead
+    def measured(*args, **kwargs):
+        sizes.append(len(json.dumps(kwargs.get("messages") or [], default=str)))
+        return function(*args, **kwargs)
+    return measured
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def run_scenario(script, latency=0.0):
+    work_dir = tempfile.mkdtemp(prefix="ditto-bench-")
+    project_dir = os.path.join(work_dir, "project")
+    os.makedirs(project_dir)
+    llm = ScriptedLLM(script, project_dir, latency)
+    timer = PhaseTimer()
+    message_bytes = []
+
+    patches = {
+        (main, "completion"): llm,
+        (main, "completion_with_backoff"): measure_messages(timer.wrap("llm_wait", main.completion_with_backoff), message_bytes),
+        (main, "supports_function_calling"): lambda model: True,
+        (main.ContextManager, "compact"): timer.wrap("context", main.ContextManager.compact),
+        (main, "execute_tool_calls"): timer.wrap("tools", main.execute_tool_calls),
+        (main, "commit_files"): timer.wrap("tools", main.commit_files),
+        (main, "validate_changes"): timer.wrap("tools", main.validate_changes),
+        (main, "log_event"): timer.wrap("logging", main.log_event),
+        (main, "log_to_file"): timer.wrap("logging", main.log_to_file),
+        (main, "save_checkpoint"): timer.wrap("logging", main.save_checkpoint),
+        (main.Job, "update_progress"): timer.wrap("progress", main.Job.update_progress),
+        (main.Job, "emit"): timer.wrap("progress", main.Job.emit),
+        (main, "LOGS_DIR"): os.path.join(work_dir, "logs"),
+        (main, "CHECKPOINTS_DIR"): os.path.join(work_dir, "checkpoints"),
+    }
+    originals = {target: getattr(*target) for target in patches}
+    cache_mode = main.response_cache.mode
+    main.response_cache.mode = "off"
+    for (owner, name), value in patches.items():
+        setattr(owner, name, value)
+    try:
+        job = main.Job("Benchmark run", "benchmark", project_dir, max_iterations=len(script) + 1)
+        tracemalloc.start()
+        start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        main.run_main_loop(job.user_input, project_dir, job)
+        wall = time.perf_counter() - start
+        end_memory, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        for (owner, name), value in originals.items():
+            setattr(owner, name, value)
+        main.response_cache.mode = cache_mode
+
+    iterations = sorted(key for key in timer.totals if key > 0)
+    result = {
+        "iterations": len(iterations),
+        "status": job.progress["status"],
+        "wall_seconds": wall,
+        "memory_growth_bytes": end_memory - start_memory,
+        "memory_peak_bytes": peak_memory,
+        "messages_bytes_first": message_bytes[0] if message_bytes else 0,
+        "messages_bytes_last": message_bytes[-1] if message_bytes else 0,
+        "log_bytes": os.path.getsize(job.log_path) if os.path.exists(job.log_path) else 0,
+        "phases": {}
+    }
+    per_iteration_overhead = []
+    for iteration in iterations:
+        per_iteration_overhead.append(sum(timer.totals[iteration][phase] for phase in PHASES if phase != "llm_wait"))
+    for phase in PHASES:
+        values = [timer.totals[iteration][phase] for iteration in iterations]
+        result["phases"][phase] = {
+            "total_ms": sum(values) * 1000,
+            "mean_ms": (sum(values) / len(values) * 1000) if values else 0.0,
+            "p50_ms": percentile(values, 0.5) * 1000,
+            "p95_ms": percentile(values, 0.95) * 1000
+        }
+    result["overhead_per_iteration_ms"] = {
+        "mean": (sum(per_iteration_overhead) / len(per_iteration_overhead) * 1000) if per_iteration_overhead else 0.0,
+        "p95": percentile(per_iteration_overhead, 0.95) * 1000,
+        # Overhead of the last tenth of the run; this grows if the loop is not constant per iteration
+        "tail_mean": (lambda tail: sum(tail) / len(tail) * 1000 if tail else 0.0)(per_iteration_overhead[-max(1, len(per_iteration_overhead) // 10):])
+    }
+    return result
+
+def print_report(name, result):
+    print(f"\n== {name}: {result['iterations']} iterations ({result['status']}) in {result['wall_seconds']:.3f}s ==")
+    print(f"{'phase':<10} {'total ms':>10} {'mean ms':>10} {'p50 ms':>10} {'p95 ms':>10}")
+    for phase, stats in result["phases"].items():
+        print(f"{phase:<10} {stats['total_ms']:>10.2f} {stats['mean_ms']:>10.3f} {stats['p50_ms']:>10.3f} {stats['p95_ms']:>10.3f}")
+    overhead = result["overhead_per_iteration_ms"]
+    print(f"non-LLM overhead per iteration: mean {overhead['mean']:.3f} ms, p95 {overhead['p95']:.3f} ms, last 10% {overhead['tail_mean']:.3f} ms")
+    print(f"messages sent: {result['messages_bytes_first']} -> {result['messages_bytes_last']} bytes")
+    print(f"memory: +{result['memory_growth_bytes']} bytes (peak {result['memory_peak_bytes']}), build log {result['log_bytes']} bytes")
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        current_ms = result["overhead_per_iteration_ms"]["mean"]
+        previous_ms = previous["overhead_per_iteration_ms"]["mean"]
+        if previous_ms and current_ms > previous_ms * (1 + tolerance):
+            regressions.append(f"{name}: non-LLM overhead {previous_ms:.3f} -> {current_ms:.3f} ms per iteration")
+    return regressions
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark run_main_loop overhead against a scripted LLM.")
+    parser.add_argument("--iterations", type=int, nargs="*", default=SCENARIOS, help="Synthetic scenario sizes to run.")
+    parser.add_argument("--files-per-iteration", type=int, default=3)
+    parser.add_argument("--file-bytes", type=int, default=2000)
+    parser.add_argument("--from-log", help="Replay tool activity from a flask_app_builder_log.json or logs/<id>.jsonl file.")
+    parser.add_argument("--from-cache", help="Replay responses recorded with LLM_CACHE=record from this directory.")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Simulated seconds per completion() call.")
+    parser.add_argument("--json", help="Write the results as JSON to this file.")
+    parser.add_argument("--baseline", help="Compare against a previous --json output and fail on regressions.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative slowdown against the baseline.")
+    args = parser.parse_args(argv)
+
+    scenarios = {}
+    if args.from_log:
+        scenarios[f"log:{os.path.basename(args.from_log)}"] = script_from_log(args.from_log, args.file_bytes)
+    if args.from_cache:
+        scenarios[f"cache:{os.path.basename(os.path.normpath(args.from_cache))}"] = script_from_cache(args.from_cache)
+    if not scenarios:
+        for iterations in args.iterations:
+            scenarios[f"synthetic-{iterations}"] = synthetic_script(iterations, args.files_per_iteration, args.file_bytes)
+
+    results = {}
+    for name, script in scenarios.items():
+        results[name] = run_scenario(script, args.llm_latency)
+        print_report(name, results[name])
+
+    if args.json:
+        with open(args.json, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
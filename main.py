@@ -1,76 +1,1483 @@
 import os
 import sys
+import re
+import glob
 import json
+import hashlib
+import random
 import importlib
 import traceback
-from flask import Flask, Blueprint, request, send_from_directory, render_template_string, jsonify
-from threading import Thread
-from time import sleep
-from litellm import completion, supports_function_calling
+import uuid
+import errno
+import fnmatch
+import stat
+import asyncio
+import weakref
+import ast
+import builtins
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait as wait_futures, FIRST_COMPLETED
+from collections import deque
+from contextvars import ContextVar, copy_context
+from itertools import islice
+from types import SimpleNamespace, ModuleType
+from bisect import bisect_left
+from email.utils import parsedate_to_datetime
+from queue import Queue, Full
+from flask import Flask, Blueprint, Response, request, send_from_directory, jsonify, redirect, url_for, stream_with_context, make_response, g
+from werkzeug.utils import safe_join
+from jinja2 import Environment as TemplateEnvironment, TemplateSyntaxError, meta as template_meta, nodes as template_nodes
+from threading import Thread, Event, Lock, RLock, Condition
+from time import sleep, time, perf_counter
 
 # Configuration
 MODEL_NAME = os.environ.get('LITELLM_MODEL', 'gpt-4')
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECTS_DIR = os.path.join(BASE_DIR, 'projects')
-LOG_FILE = "flask_app_builder_log.json"
+LOGS_DIR = os.path.join(BASE_DIR, 'logs')
+CHECKPOINTS_DIR = os.environ.get('CHECKPOINTS_DIR', os.path.join(BASE_DIR, 'checkpoints'))
+RECOVER_BUILDS = os.environ.get('RECOVER_BUILDS', '1') == '1'
+FETCH_MAX_FILES = int(os.environ.get('FETCH_MAX_FILES', '50'))
+FETCH_MAX_FILE_BYTES = int(os.environ.get('FETCH_MAX_FILE_BYTES', '32000'))
+FETCH_MAX_TOTAL_BYTES = int(os.environ.get('FETCH_MAX_TOTAL_BYTES', '120000'))
+FILE_VIEW_PAGE_LINES = int(os.environ.get('FILE_VIEW_PAGE_LINES', '1000'))
+FILE_VIEW_MAX_BYTES = int(os.environ.get('FILE_VIEW_MAX_BYTES', str(512 * 1024)))
+CACHE_DIR = os.environ.get('LLM_CACHE_DIR', os.path.join(BASE_DIR, 'llm_cache'))
+LLM_CACHE_MODE = os.environ.get('LLM_CACHE', 'off')  # "off", "on", "record" or "replay"
+LLM_CACHE_MAX_BYTES = int(os.environ.get('LLM_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+STAGE_WRITES = os.environ.get('STAGE_WRITES', '1') == '1'
+LOG_FSYNC = os.environ.get('LOG_FSYNC', 'iteration')  # "always", "iteration" or "never"
+LOG_BUFFER_SIZE = int(os.environ.get('LOG_BUFFER_SIZE', '65536'))
+MAX_ITERATIONS = int(os.environ.get('MAX_ITERATIONS', '50'))
+MAX_CONCURRENT_BUILDS = int(os.environ.get('MAX_CONCURRENT_BUILDS', '4'))
+MAX_QUEUED_BUILDS = int(os.environ.get('MAX_QUEUED_BUILDS', '100'))
+MAX_FINISHED_JOBS = int(os.environ.get('MAX_FINISHED_JOBS', '200'))
+EVENT_CHUNK_SIZE = int(os.environ.get('EVENT_CHUNK_SIZE', '256'))
+SSE_KEEPALIVE_SECONDS = float(os.environ.get('SSE_KEEPALIVE_SECONDS', '15'))
+LOOP_MODE = os.environ.get('LOOP_MODE', 'single')  # "single" or "narrate"
+GENERATION_MODE = os.environ.get('GENERATION_MODE', 'iterative')  # "iterative" or "fanout"
+FANOUT_WORKERS = int(os.environ.get('FANOUT_WORKERS', '8'))
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '60000'))
+CONTEXT_KEEP_RECENT_TURNS = int(os.environ.get('CONTEXT_KEEP_RECENT_TURNS', '6'))
+CONTEXT_COMPACT_TARGET = float(os.environ.get('CONTEXT_COMPACT_TARGET', '0.75'))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '5'))
+LLM_BACKOFF_BASE = float(os.environ.get('LLM_BACKOFF_BASE', '1.0'))
+LLM_BACKOFF_MAX = float(os.environ.get('LLM_BACKOFF_MAX', '60.0'))
+BUILD_ENGINE = os.environ.get('BUILD_ENGINE', 'threads')  # "threads" or "asyncio"
+MAX_ASYNC_BUILDS = int(os.environ.get('MAX_ASYNC_BUILDS', '64'))
+MAX_OUTSTANDING_LLM_REQUESTS = int(os.environ.get('MAX_OUTSTANDING_LLM_REQUESTS', '16'))
+LLM_TIMEOUT = float(os.environ.get('LLM_TIMEOUT', '300'))
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'litellm')  # "litellm" or "package.module:BackendClass"
+LLM_WARMUP = os.environ.get('LLM_WARMUP', '0') == '1'
+LIVE_MOUNTS = os.environ.get('LIVE_MOUNTS', '0') == '1'
 
 app = Flask(__name__)
 
-# Initialize progress tracking
-progress = {
-    "status": "idle",
-    "iteration": 0,
-    "max_iterations": 50,
-    "output": "",
-    "completed": False
-}
+# Minimal Prometheus-style metrics. Recording is a bisect and a few additions under a
+# per-metric lock; rendering to the text exposition format happens only on scrape.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+ITERATION_BUCKETS = (1, 2, 5, 10, 20, 30, 40, 50, 75, 100)
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name + format_labels(self.labels, key), value) for key, value in sorted(self.values.items())]
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help_text, collect):
+        self.name = name
+        self.help_text = help_text
+        self.collect = collect
+
+    def samples(self):
+        return [(self.name, self.collect())]
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self.lock = Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *label_values):
+        return Timer(self, label_values)
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items())
+        samples = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                le = bound if bound == "+Inf" else format_value(bound)
+                samples.append((self.name + "_bucket" + format_labels(self.labels, key, [("le", le)]), cumulative))
+            samples.append((self.name + "_sum" + format_labels(self.labels, key), total))
+            samples.append((self.name + "_count" + format_labels(self.labels, key), count))
+        return samples
+
+class Timer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(perf_counter() - self.start, *self.label_values)
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+LLM_LATENCY = metrics.register(Histogram("ditto_llm_request_seconds", "Latency of LLM completion calls.", ("model", "source")))
+LLM_TOKENS = metrics.register(Counter("ditto_llm_tokens_total", "Tokens reported by the LLM provider.", ("model", "type")))
+LLM_ERRORS = metrics.register(Counter("ditto_llm_errors_total", "LLM completion calls that raised.", ("model", "error")))
+TOOL_LATENCY = metrics.register(Histogram("ditto_tool_seconds", "Latency of tool calls.", ("tool",)))
+TOOL_ERRORS = metrics.register(Counter("ditto_tool_errors_total", "Tool calls that failed or returned an error.", ("tool",)))
+LOG_FLUSH_LATENCY = metrics.register(Histogram("ditto_log_flush_seconds", "Latency of build log flushes."))
+ROUTE_LATENCY = metrics.register(Histogram("ditto_http_request_seconds", "Latency of HTTP requests.", ("endpoint", "method", "status")))
+BUILDS = metrics.register(Counter("ditto_builds_total", "Finished builds.", ("status",)))
+BUILD_ITERATIONS = metrics.register(Histogram("ditto_build_iterations", "Iterations used per finished build.", (), ITERATION_BUCKETS))
+
+def usage_counts(response):
+    # Prompt tokens split into those served from the provider's prompt cache and the rest.
+    # OpenAI-style usage reports them in prompt_tokens_details; Anthropic as cache_read_input_tokens.
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return None
+    prompt = getattr(usage, "prompt_tokens", None) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = details.get("cached_tokens") if isinstance(details, dict) else getattr(details, "cached_tokens", None)
+    cached = cached or getattr(usage, "cache_read_input_tokens", None) or 0
+    return {
+        "prompt": prompt,
+        "cached": cached,
+        "uncached": max(prompt - cached, 0),
+        "completion": getattr(usage, "completion_tokens", None) or 0
+    }
+
+def record_usage(model, response):
+    counts = usage_counts(response)
+    if counts is None:
+        return
+    for kind in ("prompt", "completion", "cached", "uncached"):
+        if counts[kind]:
+            LLM_TOKENS.inc(model, kind, amount=counts[kind])
+
+# The job whose build is running in the current thread/context, so tools can reach its state
+current_job = ContextVar('current_job', default=None)
+
+class Job:
+    def __init__(self, user_input, project_name, project_dir, max_iterations=MAX_ITERATIONS, loop_mode=LOOP_MODE,
+                 context_budget=CONTEXT_TOKEN_BUDGET, engine=BUILD_ENGINE, job_id=None, resume=None,
+                 generation_mode=GENERATION_MODE):
+        self.id = job_id or uuid.uuid4().hex
+        self.user_input = user_input
+        self.project_name = project_name
+        self.project_dir = project_dir
+        self.loop_mode = loop_mode
+        self.generation_mode = generation_mode
+        self.context_budget = context_budget
+        self.engine = engine
+        # Checkpoint state to continue from (messages, iteration) and the last checkpoint written
+        self.resume = resume
+        self.checkpoint = None
+        self.checkpoint_messages = 0
+        self.manifest_versions = {}
+        # Validation state: per-file analysis keyed by content hash, per-file problems, and problems already reported
+        self.file_facts = {}
+        self.file_diagnostics = {}
+        self.validation_index = None
+        self.reported_diagnostics = set()
+        self.log_path = os.path.join(LOGS_DIR, f"{self.id}.jsonl")
+        self.created_at = time()
+        self.cancel_event = Event()
+        self.events = EventBuffer()
+        self.files = FileCache()
+        # Per-job progress tracking; the HTML output lives in the event buffer
+        self.progress = {
+            "job_id": self.id,
+            "project_name": project_name,
+            "status": "queued",
+            "iteration": 0,
+            "max_iterations": max_iterations,
+            "completed": False,
+            "tokens": {"prompt": 0, "cached": 0, "uncached": 0, "completion": 0}
+        }
+        if resume:
+            self.progress["iteration"] = resume["iteration"]
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    @property
+    def finished(self):
+        return self.progress["completed"]
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def update_progress(self, **fields):
+        self.progress.update(fields)
+        self.events.append("status", dict(self.progress))
+
+    def emit(self, html):
+        self.events.append("output", html)
+
+    def output(self):
+        return self.events.render()
+
+    def snapshot(self):
+        return dict(self.progress, output=self.output())
+
+# Per-job event buffer backing both /jobs/<id>/progress and the SSE stream.
+# Event IDs are contiguous from 1 and chunks are fixed-size, so resuming from
+# Last-Event-ID is an index computation rather than a scan.
+class EventBuffer:
+    def __init__(self, chunk_size=EVENT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.chunks = [[]]
+        self.last_id = 0
+        self.closed = False
+        self.condition = Condition()
+
+    def append(self, kind, data):
+        with self.condition:
+            chunk = self.chunks[-1]
+            if len(chunk) >= self.chunk_size:
+                chunk = []
+                self.chunks.append(chunk)
+            self.last_id += 1
+            chunk.append((self.last_id, kind, data))
+            self.condition.notify_all()
+            return self.last_id
+
+    def since(self, last_id):
+        with self.condition:
+            chunk_index, offset = divmod(max(0, last_id), self.chunk_size)
+            events = []
+            for chunk in self.chunks[chunk_index:]:
+                events.extend(chunk[offset:])
+                offset = 0
+            return events
+
+    def wait(self, last_id, timeout):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.last_id > last_id or self.closed, timeout)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def render(self):
+        with self.condition:
+            return "".join(data for chunk in self.chunks for _, kind, data in chunk if kind == "output")
+
+class JobScheduler:
+    def __init__(self, max_workers=MAX_CONCURRENT_BUILDS, max_queued=MAX_QUEUED_BUILDS):
+        self.max_workers = max_workers
+        self.queue = Queue(maxsize=max_queued)
+        self.jobs = {}
+        self.lock = Lock()
+        self.workers = []
+
+    def start(self):
+        with self.lock:
+            self.workers = [worker for worker in self.workers if worker.is_alive()]
+            while len(self.workers) < self.max_workers:
+                worker = Thread(target=self._worker, name=f"build-worker-{len(self.workers) + 1}", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def submit(self, job):
+        with self.lock:
+            self._prune()
+            self.jobs[job.id] = job
+        # A resumed job already has a checkpoint; it is put back as it was if the job is rejected
+        previous = dict(job.checkpoint) if job.checkpoint else None
+        try:
+            save_checkpoint(job)
+            preload_backend()
+            if job.engine == "asyncio":
+                async_engine.submit(job, self.queue.maxsize)
+            else:
+                self.start()
+                self.queue.put_nowait(job)
+        except Full:
+            with self.lock:
+                del self.jobs[job.id]
+            # Otherwise recover_builds would run the rejected build after a restart
+            if previous:
+                write_checkpoint(job.id, previous)
+            else:
+                remove_checkpoint(job.id)
+            raise
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def active_job_for(self, project_name):
+        for job in self.list():
+            if job.project_name == project_name and not job.finished:
+                return job
+        return None
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.cancel()
+        if job.engine == "asyncio":
+            async_engine.cancel(job)
+        if job.progress["status"] == "queued":
+            # The worker skips it and finish_build never runs, so the checkpoint is updated here
+            job.update_progress(status="cancelled", completed=True)
+            save_checkpoint(job)
+            job.events.close()
+        return job
+
+    def queue_depth(self):
+        return self.queue.qsize() + async_engine.waiting
+
+    def _prune(self):
+        finished = sorted((job for job in self.jobs.values() if job.finished), key=lambda job: job.created_at)
+        for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job.id]
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if not job.cancelled:
+                    run_main_loop(job.user_input, job.project_dir, job)
+            except Exception as e:
+                abandon_build(job, e)
+            finally:
+                job.events.close()
+                self.queue.task_done()
+
+scheduler = JobScheduler()
+
+# Runs builds as coroutines on one event loop in a background thread. Waiting on the LLM
+# costs no thread, so MAX_ASYNC_BUILDS can be much larger than MAX_CONCURRENT_BUILDS;
+# MAX_OUTSTANDING_LLM_REQUESTS bounds the requests in flight across all of them.
+class AsyncEngine:
+    def __init__(self, max_builds=MAX_ASYNC_BUILDS):
+        self.max_builds = max_builds
+        self.loop = None
+        self.build_slots = None
+        self.tasks = {}
+        self.waiting = 0
+        self.lock = Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                ready = Event()
+                self.loop = asyncio.new_event_loop()
+                Thread(target=self._run, args=(ready,), name="build-engine", daemon=True).start()
+                ready.wait()
+        return self.loop
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.build_slots = asyncio.Semaphore(self.max_builds)
+        ready.set()
+        self.loop.run_forever()
+
+    def submit(self, job, max_queued=0):
+        loop = self.start()
+        with self.lock:
+            if max_queued and self.waiting >= max_queued:
+                raise Full
+            self.waiting += 1
+        asyncio.run_coroutine_threadsafe(self._build(job), loop)
+        return job
+
+    async def _build(self, job):
+        with self.lock:
+            self.tasks[job.id] = asyncio.current_task()
+        queued = True
+        try:
+            async with self.build_slots:
+                with self.lock:
+                    self.waiting -= 1
+                queued = False
+                if not job.cancelled:
+                    await run_main_loop_async(job.user_input, job.project_dir, job)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            abandon_build(job, e)
+        finally:
+            with self.lock:
+                self.tasks.pop(job.id, None)
+                if queued:
+                    self.waiting -= 1
+            job.events.close()
+
+    def cancel(self, job):
+        # The loop checks cancel_event at every iteration; cancelling the task as well
+        # interrupts an LLM request or backoff wait that is already in progress.
+        with self.lock:
+            task = self.tasks.get(job.id)
+        if task is not None:
+            self.loop.call_soon_threadsafe(task.cancel)
+
+async_engine = AsyncEngine()
+
+metrics.register(Gauge("ditto_queue_depth", "Builds waiting to start.", lambda: scheduler.queue_depth()))
+metrics.register(Gauge("ditto_running_builds", "Builds currently running.",
+                       lambda: sum(1 for job in scheduler.list() if job.progress["status"] == "running")))
+
+# One limit on outstanding LLM requests per event loop
+llm_request_slots = weakref.WeakKeyDictionary()
+
+def llm_request_slot():
+    loop = asyncio.get_running_loop()
+    slot = llm_request_slots.get(loop)
+    if slot is None:
+        slot = llm_request_slots[loop] = asyncio.Semaphore(MAX_OUTSTANDING_LLM_REQUESTS)
+    return slot
+
+def file_key(path):
+    return os.path.normpath(os.path.abspath(path))
+
+# Per-job write-through cache of file contents. Versions count the changes the build
+# has seen to each file; "delivered" remembers which version the model already has.
+class FileCache:
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = {}
+        self.delivered = {}
+        # Entries staged since the last flush, mapped to what they replaced (None for new files)
+        self.staged = {}
+        # Delivered marks set by reads since the last flush, mapped to the mark they replaced
+        self.marked = {}
+
+    def key(self, path):
+        return file_key(path)
+
+    def write(self, path, content, delivered=True):
+        key = self.key(path)
+        with self.lock:
+            entry = self.entries.get(key)
+            version = entry["version"] + 1 if entry else 1
+            self.entries[key] = {"version": version, "content": content, "mtime_ns": self.mtime(key)}
+            if delivered:
+                self.delivered[key] = version
+            else:
+                self.delivered.pop(key, None)
+            return version
+
+    def stage(self, path, content, delivered=True):
+        # Keeps the write in memory until flush(); repeated writes to a file within an
+        # iteration replace each other and reach the disk once. Returns True for a new file.
+        key = self.key(path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if key not in self.staged:
+                self.staged[key] = dict(entry) if entry else None
+            created = entry is None and not os.path.exists(key)
+            version = entry["version"] + 1 if entry else 1
+            self.entries[key] = {"version": version, "content": content, "mtime_ns": entry["mtime_ns"] if entry else None, "dirty": True}
+            if delivered:
+                self.delivered[key] = version
+            else:
+                self.delivered.pop(key, None)
+            return created
+
+    def staged_paths(self):
+        with self.lock:
+            return list(self.staged)
+
+    def flush(self, fsync=LOG_FSYNC != "never"):
+        # Each file is written to a temporary file next to it and renamed into place,
+        # so a reader or a crash never sees a partially written file
+        with self.lock:
+            pending = [(key, self.entries[key]["content"], self.staged[key] is None) for key in self.staged]
+        for key, content, created in pending:
+            temp_path = os.path.join(os.path.dirname(key), f".{os.path.basename(key)}.{uuid.uuid4().hex[:8]}.tmp")
+            try:
+                with open(temp_path, 'w') as f:
+                    f.write(content)
+                    if fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+                if not created and os.path.exists(key):
+                    os.chmod(temp_path, stat.S_IMODE(os.stat(key).st_mode))
+                os.replace(temp_path, key)
+            except BaseException:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+                raise
+            if created:
+                invalidate_project_index(key)
+            with self.lock:
+                entry = self.entries[key]
+                entry["dirty"] = False
+                entry["mtime_ns"] = self.mtime(key)
+                self.staged.pop(key, None)
+        with self.lock:
+            self.marked.clear()
+        return [key for key, _, _ in pending]
+
+    def rollback(self):
+        # Drops staged writes and the iteration's delivered marks; the model's copies of both
+        # are discarded along with the iteration's messages
+        with self.lock:
+            rolled_back = list(self.staged)
+            for key, previous in self.marked.items():
+                if previous is None:
+                    self.delivered.pop(key, None)
+                else:
+                    self.delivered[key] = previous
+            self.marked.clear()
+            for key, previous in self.staged.items():
+                if previous is None:
+                    self.entries.pop(key, None)
+                else:
+                    self.entries[key] = previous
+                self.delivered.pop(key, None)
+            self.staged.clear()
+            return rolled_back
+
+    def read(self, path):
+        key = self.key(path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry.get("dirty"):
+                return entry["version"], entry["content"]
+        mtime = self.mtime(key)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry["mtime_ns"] == mtime:
+                return entry["version"], entry["content"]
+        with open(key, 'r') as f:
+            content = f.read()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry["content"] == content:
+                entry["mtime_ns"] = mtime
+                return entry["version"], content
+            version = entry["version"] + 1 if entry else 1
+            self.entries[key] = {"version": version, "content": content, "mtime_ns": mtime}
+            return version, content
+
+    def versions(self):
+        with self.lock:
+            return {key: entry["version"] for key, entry in self.entries.items()}
+
+    def delivered_version(self, path):
+        with self.lock:
+            return self.delivered.get(self.key(path))
+
+    def mark_delivered(self, path, version):
+        key = self.key(path)
+        with self.lock:
+            self.marked.setdefault(key, self.delivered.get(key))
+            self.delivered[key] = version
+
+    def forget_delivered(self, paths=None):
+        with self.lock:
+            if paths is None:
+                self.delivered.clear()
+                self.marked.clear()
+            for path in paths or ():
+                self.delivered.pop(self.key(path), None)
+
+    def mtime(self, key):
+        try:
+            return os.stat(key).st_mtime_ns
+        except OSError:
+            return None
+
+def write_file(path, content, delivered=True):
+    # Stages the write in the job's overlay, or writes through when there is no job or
+    # staging is off. Returns True if the file did not exist before.
+    job = current_job.get()
+    if job is not None and STAGE_WRITES:
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), directory)
+        return job.files.stage(path, content, delivered)
+    created = not os.path.exists(path)
+    with open(path, 'w') as f:
+        f.write(content)
+    if created:
+        invalidate_project_index(path)
+    if job is not None:
+        job.files.write(path, content, delivered)
+    return created
+
+def read_file(path):
+    job = current_job.get()
+    if job is None:
+        with open(path, 'r') as f:
+            return None, f.read()
+    return job.files.read(path)
 
 def create_directory(path):
     if not os.path.exists(path):
         os.makedirs(path)
+        invalidate_project_index(path)
         return f"Created directory: {path}"
     return f"Directory already exists: {path}"
 
 def create_file(path, content):
     try:
-        with open(path, 'x') as f:
-            f.write(content)
-        return f"Created file: {path}"
-    except FileExistsError:
-        with open(path, 'w') as f:
-            f.write(content)
+        if write_file(path, content):
+            return f"Created file: {path}"
         return f"Updated file: {path}"
     except Exception as e:
         return f"Error creating/updating file {path}: {e}"
 
 def update_file(path, content):
     try:
-        with open(path, 'w') as f:
-            f.write(content)
+        write_file(path, content)
         return f"Updated file: {path}"
     except Exception as e:
         return f"Error updating file {path}: {e}"
 
+HUNK_HEADER = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+def parse_unified_diff(diff):
+    hunks = []
+    lines = diff.splitlines()
+    index = 0
+    while index < len(lines):
+        match = HUNK_HEADER.match(lines[index])
+        index += 1
+        if not match:
+            continue  # File headers and other preamble
+        old_remaining = int(match.group(2)) if match.group(2) is not None else 1
+        new_remaining = int(match.group(4)) if match.group(4) is not None else 1
+        hunk = {"start": int(match.group(1)), "old": [], "new": []}
+        while (old_remaining > 0 or new_remaining > 0) and index < len(lines):
+            line = lines[index]
+            index += 1
+            if line.startswith('\\'):
+                continue  # "\ No newline at end of file"
+            tag, text = (line[:1], line[1:]) if line else (' ', '')
+            if tag == ' ':
+                hunk["old"].append(text)
+                hunk["new"].append(text)
+                old_remaining -= 1
+                new_remaining -= 1
+            elif tag == '-':
+                hunk["old"].append(text)
+                old_remaining -= 1
+            elif tag == '+':
+                hunk["new"].append(text)
+                new_remaining -= 1
+            else:
+                raise ValueError(f"malformed diff line {line!r}")
+        if old_remaining > 0 or new_remaining > 0:
+            raise ValueError(f"hunk starting at line {hunk['start']} is truncated")
+        hunks.append(hunk)
+    if not hunks:
+        raise ValueError("diff contains no hunks")
+    return hunks
+
+def apply_unified_diff(content, diff):
+    lines = content.splitlines()
+    offset = 0
+    for number, hunk in enumerate(parse_unified_diff(diff), 1):
+        old, new = hunk["old"], hunk["new"]
+        # Zero-length ranges refer to the line *after* which to insert
+        original_index = hunk["start"] if not old else hunk["start"] - 1
+        expected = original_index + offset
+        if 0 <= expected <= len(lines) and lines[expected:expected + len(old)] == old:
+            position = expected
+        elif old:
+            matches = [i for i in range(len(lines) - len(old) + 1) if lines[i:i + len(old)] == old]
+            if len(matches) != 1:
+                raise ValueError(f"hunk {number} (line {hunk['start']}) does not apply cleanly")
+            position = matches[0]
+        else:
+            raise ValueError(f"hunk {number} inserts at line {hunk['start']}, past the end of the file")
+        lines[position:position + len(old)] = new
+        offset = position + len(new) - (original_index + len(old))
+    return "\n".join(lines) + ("\n" if lines and (content.endswith("\n") or not content) else "")
+
+def apply_search_replace(content, edits):
+    for number, edit in enumerate(edits, 1):
+        search = edit.get("search", "")
+        if not search:
+            raise ValueError(f"edit {number} has an empty search string")
+        occurrences = content.count(search)
+        if occurrences == 0:
+            raise ValueError(f"edit {number}: search text not found")
+        if occurrences > 1:
+            raise ValueError(f"edit {number}: search text matches {occurrences} times, include more context")
+        content = content.replace(search, edit.get("replace", ""), 1)
+    return content
+
+def edit_file(path, edits=None, diff=None):
+    try:
+        if not edits and not diff:
+            return f"Error editing file {path}: provide either edits or diff"
+        if isinstance(edits, str):
+            edits = json.loads(edits)
+        _, content = read_file(path)
+        if diff:
+            content = apply_unified_diff(content, diff)
+        if edits:
+            content = apply_search_replace(content, edits)
+        # The model only sent the change, so it does not hold the full new version yet
+        write_file(path, content, delivered=False)
+        digest = hashlib.sha256(content.encode('utf-8')).hexdigest()[:12]
+        changes = f"{len(parse_unified_diff(diff))} hunks" if diff else f"{len(edits)} edits"
+        return f"Edited file: {path} ({changes} applied, {content.count(chr(10))} lines, sha256 {digest})"
+    except Exception as e:
+        return f"Error editing file {path}: {e}. The file was not changed."
+
 def fetch_code(file_path):
     try:
-        with open(file_path, 'r') as f:
-            code = f.read()
+        version, code = read_file(file_path)
+        job = current_job.get()
+        if job is not None:
+            job.files.mark_delivered(file_path, version)
         return code
     except Exception as e:
         return f"Error fetching code from {file_path}: {e}"
 
+def fetch_files(paths=None, pattern=None, max_file_bytes=None, max_total_bytes=None, force=False):
+    job = current_job.get()
+    max_file_bytes = min(max_file_bytes or FETCH_MAX_FILE_BYTES, FETCH_MAX_FILE_BYTES)
+    max_total_bytes = min(max_total_bytes or FETCH_MAX_TOTAL_BYTES, FETCH_MAX_TOTAL_BYTES)
+    if isinstance(paths, str):
+        paths = [paths]
+    targets = list(paths or [])
+    if pattern:
+        if not os.path.isabs(pattern) and job is not None:
+            pattern = os.path.join(job.project_dir, pattern)
+        matches = {path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path)}
+        if job is not None:
+            # Files staged in this iteration are not on disk yet
+            matches.update(path for path in job.files.staged_paths() if fnmatch.fnmatch(path, os.path.abspath(pattern)))
+        targets.extend(sorted(matches))
+    if not targets:
+        return "Error fetching files: provide paths or a pattern that matches at least one file."
+
+    sections = []
+    skipped = []
+    total = 0
+    seen = set()
+    for path in targets:
+        key = os.path.normpath(os.path.abspath(path))
+        if key in seen:
+            continue
+        seen.add(key)
+        if len(seen) > FETCH_MAX_FILES:
+            skipped.append(path)
+            continue
+        try:
+            version, content = read_file(path)
+        except Exception as e:
+            sections.append(f"=== {path}: error: {e} ===")
+            continue
+        if not force and job is not None and version is not None and job.files.delivered_version(path) == version:
+            sections.append(f"=== {path}: unchanged since version {version} (already in context) ===")
+            continue
+        if total >= max_total_bytes:
+            skipped.append(path)
+            continue
+        truncated = len(content) > max_file_bytes or total + min(len(content), max_file_bytes) > max_total_bytes
+        body = content[:min(max_file_bytes, max_total_bytes - total)]
+        total += len(body)
+        header = f"=== {path} (version {version}, {len(content.splitlines())} lines) ===" if version is not None else f"=== {path} ==="
+        if truncated:
+            header += f"\n[truncated to {len(body)} of {len(content)} characters]"
+        elif job is not None and version is not None:
+            job.files.mark_delivered(path, version)
+        sections.append(f"{header}\n{body}")
+    if skipped:
+        sections.append(f"[not returned, size or file limit reached: {', '.join(skipped)}]")
+    return "\n".join(sections)
+
 def task_completed():
-    progress["status"] = "completed"
-    progress["completed"] = True
+    # The build loop marks the job completed once the iteration's writes are committed;
+    # until then a failed commit must leave the job running
     return "Task marked as completed."
 
-def log_to_file(history_dict):
+# Append-only JSON Lines build log, one file per job
+class BuildLog:
+    def __init__(self, path, fsync=LOG_FSYNC, buffer_size=LOG_BUFFER_SIZE):
+        self.path = path
+        self.fsync = fsync
+        self.lock = Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'a', buffering=buffer_size, encoding='utf-8')
+
+    def append(self, event_type, iteration, **fields):
+        record = {"type": event_type, "iteration": iteration, "time": time()}
+        record.update(fields)
+        line = json.dumps(record, default=str) + "\n"
+        with self.lock:
+            self.file.write(line)
+            if self.fsync == "always":
+                self._sync()
+
+    def flush(self):
+        with self.lock:
+            if self.fsync == "never":
+                self.file.flush()
+            else:
+                self._sync()
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                if self.fsync != "never":
+                    self._sync()
+                self.file.close()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+def log_to_file(build_log):
+    try:
+        with LOG_FLUSH_LATENCY.time():
+            build_log.flush()
+    except Exception as e:
+        pass  # Silent fail
+
+def log_event(build_log, event_type, iteration, **fields):
     try:
-        with open(LOG_FILE, 'w') as log_file:
-            json.dump(history_dict, log_file, indent=4)
+        build_log.append(event_type, iteration, **fields)
     except Exception as e:
         pass  # Silent fail
 
+def read_build_log(path):
+    # Rebuilds the legacy history_dict shape from a JSON Lines build log
+    history_dict = {"iterations": []}
+    current_iteration = None
+    with open(path, 'r', encoding='utf-8') as log_file:
+        for line in log_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Torn final line from an interrupted write
+            event_type = record.get("type")
+            if event_type == "iteration":
+                current_iteration = {
+                    "iteration": record["iteration"],
+                    "actions": [],
+                    "llm_responses": [],
+                    "tool_results": [],
+                    "errors": []
+                }
+                history_dict["iterations"].append(current_iteration)
+            elif current_iteration is None:
+                continue
+            elif event_type == "llm_response":
+                current_iteration["llm_responses"].append(record.get("content", ""))
+            elif event_type == "tool_result":
+                current_iteration["tool_results"].append({"tool": record.get("tool"), "result": record.get("result")})
+            elif event_type == "error":
+                error = {key: record[key] for key in ("action", "error", "traceback") if key in record}
+                current_iteration["errors"].append(error)
+    return history_dict
+
+# Checkpoints hold everything needed to continue a build after a restart: the request,
+# the message list and iteration at the last iteration boundary, and a manifest of the
+# project's files with their hashes so changes made since then can be detected.
+# Messages live in an append-only sidecar; only a compaction (which edits earlier
+# messages) rewrites it. The small state file is replaced atomically and records how
+# many sidecar lines belong to the checkpoint, so a torn append is ignored on load.
+def checkpoint_path(job_id):
+    return os.path.join(CHECKPOINTS_DIR, f"{job_id}.json")
+
+def checkpoint_messages_path(job_id):
+    return os.path.join(CHECKPOINTS_DIR, f"{job_id}.messages.jsonl")
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def project_manifest(project_dir):
+    manifest = {}
+    files, _ = get_project_index(project_dir).listing()
+    for relative in files:
+        try:
+            manifest[relative] = file_digest(os.path.join(project_dir, relative))
+        except OSError:
+            continue
+    return manifest
+
+def update_manifest(job, manifest):
+    # After the first full scan only files the build touched are re-hashed; the tools
+    # are the only writers, and every write goes through the job's file cache.
+    if not manifest:
+        manifest = project_manifest(job.project_dir)
+    for key, version in job.files.versions().items():
+        if job.manifest_versions.get(key) == version:
+            continue
+        job.manifest_versions[key] = version
+        relative = os.path.relpath(key, os.path.abspath(job.project_dir))
+        if relative.startswith(os.pardir):
+            continue
+        try:
+            manifest[relative] = file_digest(key)
+        except OSError:
+            manifest.pop(relative, None)
+    return manifest
+
+def write_file_atomic(path, text):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+        if LOG_FSYNC != "never":
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+def write_checkpoint(job_id, data):
+    os.makedirs(CHECKPOINTS_DIR, exist_ok=True)
+    write_file_atomic(checkpoint_path(job_id), json.dumps(data, default=str, separators=(',', ':')))
+
+def write_checkpoint_messages(job, messages, rewrite):
+    path = checkpoint_messages_path(job.id)
+    start = 0 if rewrite or job.checkpoint_messages > len(messages) else job.checkpoint_messages
+    lines = "".join(json.dumps(message, default=str, separators=(',', ':')) + "\n" for message in messages[start:])
+    if start == 0:
+        write_file_atomic(path, lines)
+    elif lines:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+            if LOG_FSYNC != "never":
+                f.flush()
+                os.fsync(f.fileno())
+    job.checkpoint_messages = len(messages)
+
+def save_checkpoint(job, iteration=None, messages=None, rewrite=False):
+    data = job.checkpoint or {
+        "job_id": job.id,
+        "user_input": job.user_input,
+        "project_name": job.project_name,
+        "project_dir": job.project_dir,
+        "max_iterations": job.progress["max_iterations"],
+        "loop_mode": job.loop_mode,
+        "generation_mode": job.generation_mode,
+        "context_budget": job.context_budget,
+        "engine": job.engine,
+        "iteration": 0,
+        "message_count": 0,
+        "manifest": {}
+    }
+    data["status"] = job.progress["status"]
+    data["updated_at"] = time()
+    job.checkpoint = data
+    try:
+        os.makedirs(CHECKPOINTS_DIR, exist_ok=True)
+        if messages is not None:
+            write_checkpoint_messages(job, messages, rewrite)
+            data["iteration"] = iteration
+            data["message_count"] = len(messages)
+            data["manifest"] = update_manifest(job, data["manifest"]) if os.path.isdir(job.project_dir) else {}
+        write_checkpoint(job.id, data)
+    except Exception as e:
+        # A missed checkpoint only costs replayed iterations; rewrite the messages next time
+        job.checkpoint_messages = 0
+
+def load_checkpoint(job_id, with_messages=False):
+    try:
+        with open(checkpoint_path(job_id), 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if with_messages and checkpoint.get("message_count"):
+        try:
+            with open(checkpoint_messages_path(job_id), 'r', encoding='utf-8') as f:
+                checkpoint["messages"] = [json.loads(line) for line in islice(f, checkpoint["message_count"])]
+        except (OSError, ValueError):
+            return None
+        if len(checkpoint["messages"]) != checkpoint["message_count"]:
+            return None
+    return checkpoint
+
+def checkpoint_divergence(checkpoint):
+    project_dir = checkpoint["project_dir"]
+    current = project_manifest(project_dir) if os.path.isdir(project_dir) else {}
+    recorded = checkpoint.get("manifest") or {}
+    divergence = {
+        "modified": sorted(path for path in recorded if path in current and current[path] != recorded[path]),
+        "missing": sorted(path for path in recorded if path not in current),
+        "added": sorted(path for path in current if path not in recorded)
+    }
+    return divergence if any(divergence.values()) else None
+
+def job_from_checkpoint(checkpoint, divergence=None):
+    resume = None
+    if checkpoint.get("messages"):
+        messages = checkpoint["messages"]
+        if divergence:
+            changed = ", ".join(divergence["modified"] + divergence["missing"] + divergence["added"])
+            messages = messages + [{
+                "role": "system",
+                "content": f"The build was resumed after an interruption. These project files changed since the last checkpoint: {changed}. "
+                           "Re-read them with fetch_files before editing them."
+            }]
+        resume = {"iteration": checkpoint["iteration"], "messages": messages}
+    job = Job(checkpoint["user_input"], checkpoint["project_name"], checkpoint["project_dir"],
+              max_iterations=checkpoint["max_iterations"], loop_mode=checkpoint["loop_mode"],
+              context_budget=checkpoint["context_budget"], engine=checkpoint.get("engine", BUILD_ENGINE),
+              job_id=checkpoint["job_id"], resume=resume,
+              generation_mode=checkpoint.get("generation_mode", GENERATION_MODE))
+    job.checkpoint = {key: value for key, value in checkpoint.items() if key not in ("divergence", "messages")}
+    if divergence:
+        # The recorded hashes describe the old project; the next checkpoint rescans it
+        job.checkpoint["manifest"] = {}
+    job.checkpoint_messages = checkpoint.get("message_count", 0)
+    return job
+
+def remove_checkpoint(job_id):
+    for path in (checkpoint_path(job_id), checkpoint_messages_path(job_id)):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def recover_builds():
+    # Builds whose checkpoint is still queued or running were interrupted by a restart.
+    # Unchanged projects are resubmitted; diverged ones wait for an explicit resume.
+    if not os.path.isdir(CHECKPOINTS_DIR):
+        return []
+    recovered = []
+    for name in sorted(os.listdir(CHECKPOINTS_DIR)):
+        if not name.endswith(".json"):
+            continue
+        checkpoint = load_checkpoint(name[:-len(".json")], with_messages=True)
+        if not checkpoint or checkpoint.get("status") not in ("queued", "running"):
+            continue
+        divergence = checkpoint_divergence(checkpoint)
+        if divergence:
+            checkpoint["status"] = "interrupted"
+            checkpoint["divergence"] = divergence
+            # The messages stay in the sidecar; the state file only records how many there are
+            checkpoint.pop("messages", None)
+            write_checkpoint(checkpoint["job_id"], checkpoint)
+            continue
+        try:
+            recovered.append(scheduler.submit(job_from_checkpoint(checkpoint)))
+        except Full:
+            break
+    return recovered
+
+# Per-project file index for the browser. A listing is reused until a directory in
+# the project changes its mtime or a tool writes into the project.
+class ProjectIndex:
+    def __init__(self, root):
+        self.root = root
+        self.lock = Lock()
+        self.files = []
+        self.dir_mtimes = {}
+        self.signature = None
+        self.valid = False
+
+    def invalidate(self):
+        self.valid = False
+
+    def is_stale(self):
+        if not self.valid:
+            return True
+        for directory, mtime in self.dir_mtimes.items():
+            try:
+                if os.stat(directory).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def refresh(self):
+        self.valid = True  # Set first so a write during the walk invalidates this listing
+        files = []
+        dir_mtimes = {}
+        for root, dirs, filenames in os.walk(self.root):
+            dirs.sort()
+            try:
+                dir_mtimes[root] = os.stat(root).st_mtime_ns
+            except OSError:
+                continue
+            for filename in sorted(filenames):
+                files.append(os.path.relpath(os.path.join(root, filename), self.root))
+        self.files = files
+        self.dir_mtimes = dir_mtimes
+        self.signature = hashlib.sha1("\0".join(files).encode("utf-8")).hexdigest()[:16]
+
+    def listing(self):
+        with self.lock:
+            if self.is_stale():
+                self.refresh()
+            return self.files, self.signature
+
+project_indexes = {}
+project_indexes_lock = Lock()
+
+def get_project_index(project_dir):
+    project_dir = os.path.normpath(os.path.abspath(project_dir))
+    with project_indexes_lock:
+        index = project_indexes.get(project_dir)
+        if index is None:
+            index = project_indexes[project_dir] = ProjectIndex(project_dir)
+        return index
+
+def invalidate_project_index(path):
+    path = os.path.normpath(os.path.abspath(path))
+    with project_indexes_lock:
+        indexes = list(project_indexes.items())
+    for root, index in indexes:
+        if path == root or path.startswith(root + os.sep):
+            index.invalidate()
+
+# Live mounting: a generated project's routes/ modules are imported into the server and
+# their blueprints served under /live/<project>/. Every project gets its own package in
+# sys.modules (ditto_live.<project>), and its modules resolve the project's top-level
+# imports ("from models import db") inside that package, so projects never see each
+# other's modules. Loaded modules are cached by file hash; when files change, only the
+# changed modules and the modules that imported them are executed again.
+LIVE_PACKAGE = 'ditto_live'
+
+class LiveProject:
+    def __init__(self, name, root):
+        self.name = name
+        self.root = root
+        self.namespace = LIVE_PACKAGE + '.' + re.sub(r'\W', '_', name)
+        self.lock = RLock()  # Re-entered by imports made while a module executes
+        self.secret_key = os.urandom(16)
+        self.modules = {}  # local module name -> (sha256 of its source, module)
+        self.dependents = {}  # local module name -> local modules that imported it
+        self.local_names = set()
+        self.signature = None
+        self.app = None
+        self.blueprints = []
+        self.errors = {}
+        self.reloaded = []
+        self.reloads = 0
+        self.builtins = dict(vars(builtins), __import__=self.import_hook)
+        self.package = self.new_module(self.namespace, root, is_package=True)
+
+    def new_module(self, qualified_name, path, is_package=False):
+        module = ModuleType(qualified_name)
+        module.__builtins__ = self.builtins
+        if is_package:
+            module.__path__ = [path]
+            module.__package__ = qualified_name
+        else:
+            module.__package__ = qualified_name.rpartition('.')[0]
+        if os.path.isfile(path):
+            module.__file__ = path
+        return module
+
+    def source_path(self, name):
+        base = os.path.join(self.root, *name.split('.'))
+        if os.path.isfile(base + '.py'):
+            return base + '.py', False
+        if os.path.isfile(os.path.join(base, '__init__.py')):
+            return os.path.join(base, '__init__.py'), True
+        if os.path.isdir(base):
+            return base, True  # Namespace package: a plain directory of modules
+        return None, False
+
+    def digest(self, name):
+        path, _ = self.source_path(name)
+        if path is None:
+            return None
+        return file_digest(path) if os.path.isfile(path) else 'directory'
+
+    def scan(self):
+        files, _ = get_project_index(self.root).listing()
+        signature = []
+        for relative in files:
+            if relative.endswith('.py'):
+                try:
+                    info = os.stat(os.path.join(self.root, relative))
+                except OSError:
+                    continue
+                signature.append((relative, info.st_mtime_ns, info.st_size))
+        local_names = {relative.split(os.sep, 1)[0].rsplit('.py', 1)[0] for relative, _, _ in signature}
+        return tuple(signature), local_names
+
+    def load(self, name, importer=None):
+        # Loads every package on the way down, as the import system would
+        parts = name.split('.')
+        module = None
+        for depth in range(1, len(parts) + 1):
+            module = self.load_one('.'.join(parts[:depth]))
+            if importer is not None and importer != module.__name__:
+                self.dependents.setdefault('.'.join(parts[:depth]), set()).add(importer)
+        return module
+
+    def load_one(self, name):
+        cached = self.modules.get(name)
+        if cached is not None:
+            return cached[1]
+        path, is_package = self.source_path(name)
+        if path is None:
+            raise ModuleNotFoundError(f"No module named '{name}' in project {self.name}", name=name)
+        qualified_name = f"{self.namespace}.{name}"
+        module = self.new_module(qualified_name, os.path.dirname(path) if is_package and os.path.isfile(path) else path, is_package)
+        if os.path.isfile(path):
+            module.__file__ = path
+            with open(path, 'rb') as f:
+                source = f.read()
+            digest = hashlib.sha256(source).hexdigest()
+        else:
+            source, digest = None, 'directory'
+        # Registered before executing so circular imports see the partial module
+        self.modules[name] = (digest, module)
+        sys.modules[qualified_name] = module
+        parent, _, child = name.rpartition('.')
+        setattr(self.modules[parent][1] if parent else self.package, child, module)
+        if source is not None:
+            try:
+                exec(compile(source, path, 'exec'), module.__dict__)
+            except BaseException:
+                self.modules.pop(name, None)
+                sys.modules.pop(qualified_name, None)
+                raise
+        return module
+
+    def local_name(self, qualified_name):
+        if qualified_name == self.namespace:
+            return ''
+        if qualified_name and qualified_name.startswith(self.namespace + '.'):
+            return qualified_name[len(self.namespace) + 1:]
+        return None
+
+    def import_hook(self, name, globals=None, locals=None, fromlist=(), level=0):
+        importer = self.local_name((globals or {}).get('__name__'))
+        if level > 0:
+            package = self.local_name((globals or {}).get('__package__'))
+            if package is None:
+                return builtins.__import__(name, globals, locals, fromlist, level)
+            base = package.split('.') if package else []
+            if level > 1:
+                base = base[:len(base) - (level - 1)]
+            target = '.'.join(base + ([name] if name else []))
+        elif name.split('.')[0] in self.local_names:
+            target = name
+        else:
+            return builtins.__import__(name, globals, locals, fromlist, level)
+
+        with self.lock:
+            module = self.load(target, importer) if target else self.package
+            if fromlist:
+                for item in fromlist:
+                    if item == '*':
+                        continue
+                    submodule = f"{target}.{item}" if target else item
+                    # Loaded submodules are loaded again through load() so the dependency is recorded
+                    loaded = self.modules.get(submodule)
+                    if loaded is not None and getattr(module, item, None) is loaded[1]:
+                        self.load(submodule, importer)
+                    elif not hasattr(module, item) and self.source_path(submodule)[0] is not None:
+                        self.load(submodule, importer)
+                return module
+            if level > 0:
+                return module
+            return self.modules[name.split('.')[0]][1]
+
+    def invalidate(self, names):
+        # Drops the given modules and, transitively, every module that imported them
+        stale = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name in stale:
+                continue
+            stale.add(name)
+            pending.extend(self.dependents.get(name, ()))
+        for name in stale:
+            cached = self.modules.pop(name, None)
+            sys.modules.pop(f"{self.namespace}.{name}", None)
+            self.dependents.pop(name, None)
+            # Otherwise "from package import name" would still find the old module on its parent
+            parent, _, child = name.rpartition('.')
+            parent_module = self.modules.get(parent, (None, None))[1] if parent else self.package
+            if cached is not None and parent_module is not None and getattr(parent_module, child, None) is cached[1]:
+                delattr(parent_module, child)
+        for importers in self.dependents.values():
+            importers.difference_update(stale)
+        return sorted(stale)
+
+    def refresh(self):
+        signature, local_names = self.scan()
+        if signature == self.signature and self.app is not None:
+            return self.app
+        with self.lock:
+            if signature == self.signature and self.app is not None:
+                return self.app
+            changed = [name for name, (digest, _) in self.modules.items() if self.digest(name) != digest]
+            self.reloaded = self.invalidate(changed)
+            self.local_names = local_names
+            self.signature = signature
+            self.app = self.build_app()
+            self.reloads += 1
+            return self.app
+
+    def build_app(self):
+        # Flask cannot unregister blueprints, so each reload mounts them on a fresh app;
+        # unchanged modules (and their blueprint objects) come from the cache
+        live_app = Flask(self.namespace, root_path=self.root, static_folder='static', template_folder='templates')
+        live_app.secret_key = self.secret_key
+        live_app.config['TEMPLATES_AUTO_RELOAD'] = True
+        errors = {}
+        blueprints = []
+        routes_dir = os.path.join(self.root, 'routes')
+        filenames = sorted(os.listdir(routes_dir)) if os.path.isdir(routes_dir) else []
+        for filename in filenames:
+            if not filename.endswith('.py') or filename == '__init__.py':
+                continue
+            name = f"routes.{filename[:-3]}"
+            try:
+                module = self.load(name)
+                for value in list(vars(module).values()):
+                    if isinstance(value, Blueprint) and value.name not in live_app.blueprints:
+                        live_app.register_blueprint(value)
+                        blueprints.append({"name": value.name, "module": name, "url_prefix": value.url_prefix})
+            except Exception:
+                errors[name] = traceback.format_exc(limit=-3)
+        self.blueprints = blueprints
+        self.errors = errors
+        return live_app
+
+    def status(self):
+        return {
+            "project": self.name,
+            "mounted_at": f"/live/{self.name}/",
+            "namespace": self.namespace,
+            "reloads": self.reloads,
+            "reloaded": self.reloaded,
+            "modules": {name: digest for name, (digest, _) in sorted(self.modules.items())},
+            "blueprints": self.blueprints,
+            "errors": self.errors
+        }
+
+live_projects = {}
+live_projects_lock = Lock()
+
+def get_live_project(project_name):
+    project_dir = safe_join(PROJECTS_DIR, project_name)
+    if project_dir is None or not os.path.isdir(project_dir):
+        return None
+    project_dir = os.path.normpath(os.path.abspath(project_dir))
+    with live_projects_lock:
+        project = live_projects.get(project_dir)
+        if project is None:
+            project = live_projects[project_dir] = LiveProject(project_name, project_dir)
+            sys.modules.setdefault(LIVE_PACKAGE, ModuleType(LIVE_PACKAGE)).__path__ = []
+            sys.modules[project.namespace] = project.package
+        return project
+
+class LiveMounts:
+    # WSGI middleware in front of the builder app: /live/<project>/... is handed to the
+    # project's own app with SCRIPT_NAME set, so url_for in the generated code builds
+    # URLs under the mount point
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if LIVE_MOUNTS and path.startswith('/live/'):
+            project_name, slash, rest = path[len('/live/'):].partition('/')
+            project = get_live_project(project_name) if project_name else None
+            if project is not None:
+                if not slash:
+                    return redirect(f"{environ.get('SCRIPT_NAME', '')}/live/{project_name}/")(environ, start_response)
+                try:
+                    live_app = project.refresh()
+                except Exception:
+                    return Response(traceback.format_exc(), status=500, mimetype='text/plain')(environ, start_response)
+                environ = dict(environ, SCRIPT_NAME=f"{environ.get('SCRIPT_NAME', '')}/live/{project_name}", PATH_INFO=f"/{rest}")
+                return live_app(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = LiveMounts(app.wsgi_app)
+
+# Inline templates are compiled once and reused
+compiled_templates = {}
+
+def render_cached(source, **context):
+    template = compiled_templates.get(source)
+    if template is None:
+        template = compiled_templates[source] = app.jinja_env.from_string(source)
+    app.update_template_context(context)
+    return template.render(context)
+
+def not_modified(etag):
+    response = make_response("", 304)
+    response.set_etag(etag)
+    return response
+
 def get_projects():
     projects = []
     if os.path.exists(PROJECTS_DIR):
@@ -86,58 +1493,38 @@ def home():
         user_input = request.form.get('user_input')
         project_name = request.form.get('project_name')
         if not project_name:
-            return render_template_string('''
+            return render_cached('''
                 <h1>Error</h1>
                 <p>Project name is required.</p>
                 <a href="/">Back to Home</a>
             ''')
         
+        if scheduler.active_job_for(project_name):
+            return render_cached('''
+                <h1>Error</h1>
+                <p>A build for this project is already queued or running.</p>
+                <a href="/">Back to Home</a>
+            '''), 409
+
         project_dir = os.path.join(PROJECTS_DIR, project_name)
         create_directory(project_dir)
-        
-        progress["status"] = "running"
-        progress["iteration"] = 0
-        progress["output"] = ""
-        progress["completed"] = False
-        thread = Thread(target=run_main_loop, args=(user_input, project_dir))
-        thread.start()
-        return render_template_string('''
-            <!DOCTYPE html>
-            <html lang="en">
-            <head>
-                <meta charset="UTF-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>Progress - {{ project_name }}</title>
-                <style>
-                    body { font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 800px; margin: 0 auto; padding: 20px; }
-                    h1 { color: #2c3e50; }
-                    #progress { background-color: #f9f9f9; border: 1px solid #ddd; padding: 15px; border-radius: 5px; }
-                    #refresh-btn { display: none; background-color: #3498db; color: white; border: none; padding: 10px 20px; border-radius: 5px; cursor: pointer; }
-                    #refresh-btn:hover { background-color: #2980b9; }
-                </style>
-            </head>
-            <body>
-                <h1>Progress - {{ project_name }}</h1>
-                <div id="progress">{{ progress_output }}</div>
-                <button id="refresh-btn" onclick="location.reload();">Refresh Page</button>
-                <script>
-                    setInterval(function() {
-                        fetch('/progress')
-                        .then(response => response.json())
-                        .then(data => {
-                            document.getElementById('progress').innerHTML = data.output;
-                            if (data.completed) {
-                                document.getElementById('refresh-btn').style.display = 'block';
-                            }
-                        });
-                    }, 2000);
-                </script>
-            </body>
-            </html>
-        ''', progress_output=progress["output"], project_name=project_name)
+
+        generation_mode = request.form.get('generation_mode', GENERATION_MODE)
+        if generation_mode not in ("iterative", "fanout"):
+            generation_mode = GENERATION_MODE
+        job = Job(user_input, project_name, project_dir, generation_mode=generation_mode)
+        try:
+            scheduler.submit(job)
+        except Full:
+            return render_cached('''
+                <h1>Error</h1>
+                <p>Too many builds are queued. Please try again later.</p>
+                <a href="/">Back to Home</a>
+            '''), 503
+        return redirect(url_for('view_job', job_id=job.id))
     else:
         projects = get_projects()
-        return render_template_string('''
+        return render_cached('''
             <!DOCTYPE html>
             <html lang="en">
             <head>
@@ -149,7 +1536,7 @@ def home():
                     h1 { color: #2c3e50; }
                     form { background-color: #f9f9f9; border: 1px solid #ddd; padding: 20px; border-radius: 5px; }
                     label { display: block; margin-bottom: 5px; }
-                    input[type="text"], textarea { width: 100%; padding: 8px; margin-bottom: 10px; border: 1px solid #ddd; border-radius: 4px; }
+                    input[type="text"], textarea, select { width: 100%; padding: 8px; margin-bottom: 10px; border: 1px solid #ddd; border-radius: 4px; }
                     input[type="submit"] { background-color: #3498db; color: white; border: none; padding: 10px 20px; border-radius: 5px; cursor: pointer; }
                     input[type="submit"]:hover { background-color: #2980b9; }
                     .project-grid { display: grid; grid-template-columns: repeat(auto-fill, minmax(200px, 1fr)); gap: 20px; margin-top: 20px; }
@@ -163,6 +1550,11 @@ def home():
                     <input type="text" id="project_name" name="project_name" required>
                     <label for="user_input">Describe the Flask app you want to create:</label>
                     <textarea id="user_input" name="user_input" rows="6" required></textarea>
+                    <label for="generation_mode">Generation mode:</label>
+                    <select id="generation_mode" name="generation_mode">
+                        <option value="iterative" {% if generation_mode == 'iterative' %}selected{% endif %}>Step by step</option>
+                        <option value="fanout" {% if generation_mode == 'fanout' %}selected{% endif %}>Plan, then generate files in parallel</option>
+                    </select>
                     <input type="submit" value="Create Project">
                 </form>
                 <h2>Existing Projects</h2>
@@ -176,20 +1568,20 @@ def home():
                 </div>
             </body>
             </html>
-        ''', projects=projects)
+        ''', projects=projects, generation_mode=GENERATION_MODE)
 
 @app.route('/project/<project_name>')
 def view_project(project_name):
-    project_dir = os.path.join(PROJECTS_DIR, project_name)
-    if not os.path.exists(project_dir):
+    project_dir = safe_join(PROJECTS_DIR, project_name)
+    if project_dir is None or not os.path.isdir(project_dir):
         return "Project not found", 404
-    
-    files = []
-    for root, dirs, filenames in os.walk(project_dir):
-        for filename in filenames:
-            files.append(os.path.relpath(os.path.join(root, filename), project_dir))
-    
-    return render_template_string('''
+
+    files, signature = get_project_index(project_dir).listing()
+    etag = f"{project_name}-{signature}"
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    response = make_response(render_cached('''
         <!DOCTYPE html>
         <html lang="en">
         <head>
@@ -212,21 +1604,41 @@ def view_project(project_name):
                     <li><a href="/project/{{ project_name }}/file/{{ file }}">{{ file }}</a></li>
                 {% endfor %}
             </ul>
+            {% if live %}<p><a href="/live/{{ project_name }}/">Open the live app</a></p>{% endif %}
             <a href="/">Back to Home</a>
         </body>
         </html>
-    ''', project_name=project_name, files=files)
+    ''', project_name=project_name, files=files, live=LIVE_MOUNTS))
+    response.set_etag(etag)
+    return response
 
 @app.route('/project/<project_name>/file/<path:filename>')
 def view_file(project_name, filename):
-    file_path = os.path.join(PROJECTS_DIR, project_name, filename)
-    if not os.path.exists(file_path):
+    file_path = safe_join(PROJECTS_DIR, project_name, filename)
+    if file_path is None or not os.path.isfile(file_path):
         return "File not found", 404
-    
-    with open(file_path, 'r') as f:
-        content = f.read()
-    
-    return render_template_string('''
+
+    page = max(1, request.args.get('page', 1, type=int))
+    info = os.stat(file_path)
+    etag = f"{info.st_mtime_ns:x}-{info.st_size:x}-{page}"
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    # Only the requested page is read, so large files never have to fit in memory at once
+    first_line = (page - 1) * FILE_VIEW_PAGE_LINES
+    lines = []
+    size = 0
+    with open(file_path, 'r', errors='replace') as f:
+        for line in islice(f, first_line, first_line + FILE_VIEW_PAGE_LINES + 1):
+            lines.append(line)
+            size += len(line)
+            if size > FILE_VIEW_MAX_BYTES:
+                lines[-1] = line[:max(0, len(line) - (size - FILE_VIEW_MAX_BYTES))] + "\n[... truncated, use the raw view ...]\n"
+                break
+    has_next = len(lines) > FILE_VIEW_PAGE_LINES
+    content = "".join(lines[:FILE_VIEW_PAGE_LINES])
+
+    response = make_response(render_cached('''
         <!DOCTYPE html>
         <html lang="en">
         <head>
@@ -239,26 +1651,209 @@ def view_file(project_name, filename):
                 pre { background-color: #f9f9f9; border: 1px solid #ddd; padding: 15px; border-radius: 5px; overflow-x: auto; }
                 a { color: #3498db; text-decoration: none; }
                 a:hover { text-decoration: underline; }
+                .pager { margin-bottom: 10px; }
             </style>
         </head>
         <body>
             <h1>{{ filename }}</h1>
+            {% if page > 1 or has_next %}
+                <div class="pager">
+                    {% if page > 1 %}<a href="?page={{ page - 1 }}">&laquo; Previous</a>{% endif %}
+                    Lines {{ first_line + 1 }}&ndash;{{ first_line + line_count }}
+                    {% if has_next %}<a href="?page={{ page + 1 }}">Next &raquo;</a>{% endif %}
+                </div>
+            {% endif %}
             <pre><code>{{ content }}</code></pre>
+            <a href="/project/{{ project_name }}/raw/{{ filename }}">Raw</a> |
             <a href="/project/{{ project_name }}">Back to Project Files</a>
         </body>
         </html>
-    ''', filename=filename, project_name=project_name, content=content)
+    ''', filename=filename, project_name=project_name, content=content, page=page, has_next=has_next,
+        first_line=first_line, line_count=min(len(lines), FILE_VIEW_PAGE_LINES)))
+    response.set_etag(etag)
+    return response
+
+@app.route('/project/<project_name>/raw/<path:filename>')
+def view_raw_file(project_name, filename):
+    project_dir = safe_join(PROJECTS_DIR, project_name)
+    if project_dir is None:
+        return "File not found", 404
+    # send_from_directory handles ETag/If-None-Match and Range requests
+    return send_from_directory(project_dir, filename, mimetype='text/plain', conditional=True)
+
+@app.route('/jobs/<job_id>')
+def view_job(job_id):
+    job = scheduler.get(job_id)
+    if job is None:
+        return "Job not found", 404
+    return render_cached('''
+        <!DOCTYPE html>
+        <html lang="en">
+        <head>
+            <meta charset="UTF-8">
+            <meta name="viewport" content="width=device-width, initial-scale=1.0">
+            <title>Progress - {{ project_name }}</title>
+            <style>
+                body { font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 800px; margin: 0 auto; padding: 20px; }
+                h1 { color: #2c3e50; }
+                #progress { background-color: #f9f9f9; border: 1px solid #ddd; padding: 15px; border-radius: 5px; }
+                #refresh-btn { display: none; background-color: #3498db; color: white; border: none; padding: 10px 20px; border-radius: 5px; cursor: pointer; }
+                #refresh-btn:hover { background-color: #2980b9; }
+                #cancel-btn { background-color: #e74c3c; color: white; border: none; padding: 10px 20px; border-radius: 5px; cursor: pointer; margin-bottom: 10px; }
+            </style>
+        </head>
+        <body>
+            <h1>Progress - {{ project_name }}</h1>
+            <p>Status: <span id="status">{{ progress.status }}</span></p>
+            <p>Prompt tokens: <span id="tokens">{{ progress.tokens.prompt }} ({{ progress.tokens.cached }} cached)</span></p>
+            <button id="cancel-btn" onclick="fetch('/jobs/{{ job_id }}/cancel', {method: 'POST'});">Cancel Build</button>
+            <div id="progress"></div>
+            <button id="refresh-btn" onclick="location.reload();">Refresh Page</button>
+            <script>
+                var source = new EventSource('/jobs/{{ job_id }}/events');
+                source.addEventListener('output', function(event) {
+                    document.getElementById('progress').insertAdjacentHTML('beforeend', JSON.parse(event.data));
+                });
+                source.addEventListener('status', function(event) {
+                    var data = JSON.parse(event.data);
+                    document.getElementById('status').textContent = data.status;
+                    document.getElementById('tokens').textContent = data.tokens.prompt + ' (' + data.tokens.cached + ' cached)';
+                    if (data.completed) {
+                        document.getElementById('refresh-btn').style.display = 'block';
+                        document.getElementById('cancel-btn').style.display = 'none';
+                    }
+                });
+                source.addEventListener('end', function() {
+                    source.close();
+                });
+            </script>
+        </body>
+        </html>
+    ''', progress=job.progress, job_id=job.id, project_name=job.project_name)
+
+@app.route('/jobs/<job_id>/events')
+def stream_job_events(job_id):
+    job = scheduler.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+    except ValueError:
+        last_event_id = 0
+
+    def generate(last_id):
+        yield "retry: 2000\n\n"
+        while True:
+            closed = job.events.closed
+            events = job.events.since(last_id)
+            for event_id, kind, data in events:
+                yield f"id: {event_id}\nevent: {kind}\ndata: {json.dumps(data)}\n\n"
+                last_id = event_id
+            if events:
+                continue
+            if closed:
+                yield "event: end\ndata: {}\n\n"
+                return
+            if not job.events.wait(last_id, SSE_KEEPALIVE_SECONDS):
+                yield ": keep-alive\n\n"
+
+    return Response(
+        stream_with_context(generate(last_event_id)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/jobs')
+def list_jobs():
+    jobs = [dict(job.progress) for job in scheduler.list()]
+    return jsonify({"jobs": jobs, "queue_depth": scheduler.queue_depth(), "max_concurrent_builds": scheduler.max_workers})
+
+@app.route('/jobs/<job_id>/progress')
+def get_progress(job_id):
+    job = scheduler.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.snapshot())
+
+@app.route('/jobs/<job_id>/history')
+def get_history(job_id):
+    job = scheduler.get(job_id)
+    log_path = job.log_path if job else os.path.join(LOGS_DIR, f"{os.path.basename(job_id)}.jsonl")
+    if not os.path.exists(log_path):
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(read_build_log(log_path))
+
+@app.route('/llm-cache')
+def llm_cache_stats():
+    return jsonify(response_cache.stats())
+
+@app.route('/llm-routes')
+def llm_route_stats():
+    return jsonify({name: route.stats() for name, route in model_routes.items()})
+
+@app.route('/project/<project_name>/live')
+def live_project_status(project_name):
+    if not LIVE_MOUNTS:
+        return jsonify({"error": "Live mounts are disabled (LIVE_MOUNTS=1 enables them)"}), 404
+    project = get_live_project(project_name)
+    if project is None:
+        return jsonify({"error": "Project not found"}), 404
+    try:
+        project.refresh()
+    except Exception:
+        return jsonify(dict(project.status(), error=traceback.format_exc(limit=-3))), 500
+    return jsonify(project.status())
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = scheduler.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.progress)
+
+@app.route('/jobs/<job_id>/resume', methods=['POST'])
+def resume_job(job_id):
+    # ?force=1 resumes even if the project changed since the checkpoint; the model is told which files changed
+    checkpoint = load_checkpoint(job_id, with_messages=True)
+    if checkpoint is None:
+        return jsonify({"error": "No checkpoint for this job"}), 404
+    job = scheduler.get(job_id)
+    if (job is not None and not job.finished) or checkpoint.get("status") == "completed":
+        return jsonify({"error": "Job is not resumable", "status": checkpoint.get("status")}), 409
+    if scheduler.active_job_for(checkpoint["project_name"]):
+        return jsonify({"error": "Another build is already running for this project"}), 409
+    divergence = checkpoint_divergence(checkpoint)
+    if divergence and request.args.get('force') != '1':
+        return jsonify({"error": "Project has diverged from the checkpoint", "divergence": divergence}), 409
+    try:
+        job = scheduler.submit(job_from_checkpoint(checkpoint, divergence))
+    except Full:
+        return jsonify({"error": "Build queue is full, try again later"}), 503
+    return jsonify(dict(job.progress, divergence=divergence))
 
-@app.route('/progress')
-def get_progress():
-    return jsonify(progress)
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.before_request
+def start_request_timer():
+    g.request_start = perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    start = g.get('request_start')
+    if start is not None:
+        ROUTE_LATENCY.observe(perf_counter() - start, request.endpoint or "unmatched", request.method, response.status_code)
+    return response
 
 # Available functions for the LLM
 available_functions = {
     "create_directory": create_directory,
     "create_file": create_file,
     "update_file": update_file,
+    "edit_file": edit_file,
     "fetch_code": fetch_code,
+    "fetch_files": fetch_files,
     "task_completed": task_completed
 }
 
@@ -323,6 +1918,45 @@ tools = [
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "edit_file",
+            "description": "Applies targeted edits to an existing file instead of rewriting it. Pass either a list of search/replace edits or a unified diff. Edits that no longer match the file are rejected and the file is left unchanged.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "path": {
+                        "type": "string",
+                        "description": "The file path to edit."
+                    },
+                    "edits": {
+                        "type": "array",
+                        "description": "Edits applied in order. Each search string must match exactly once in the current file.",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "search": {
+                                    "type": "string",
+                                    "description": "The exact text to replace, with enough surrounding context to be unique."
+                                },
+                                "replace": {
+                                    "type": "string",
+                                    "description": "The replacement text."
+                                }
+                            },
+                            "required": ["search", "replace"]
+                        }
+                    },
+                    "diff": {
+                        "type": "string",
+                        "description": "A unified diff (with @@ hunk headers) to apply to the file."
+                    }
+                },
+                "required": ["path"]
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
@@ -343,7 +1977,41 @@ tools = [
     {
         "type": "function",
         "function": {
-            "name": "task_completed",
+            "name": "fetch_files",
+            "description": "Retrieves several files in one call, by explicit paths and/or a glob pattern relative to the project directory. Files you already have the current version of are answered with a short 'unchanged since version N' note instead of their contents.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "paths": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "The file paths to fetch."
+                    },
+                    "pattern": {
+                        "type": "string",
+                        "description": "A glob pattern such as 'templates/**/*.html'."
+                    },
+                    "max_file_bytes": {
+                        "type": "integer",
+                        "description": "Maximum characters returned per file."
+                    },
+                    "max_total_bytes": {
+                        "type": "integer",
+                        "description": "Maximum characters returned in total."
+                    },
+                    "force": {
+                        "type": "boolean",
+                        "description": "Return contents even for files that are unchanged since you last saw them."
+                    }
+                },
+                "required": []
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "task_completed",
             "description": "Indicates that the assistant has completed the task.",
             "parameters": {
                 "type": "object",
@@ -354,180 +2022,1783 @@ tools = [
     }
 ]
 
-def run_main_loop(user_input, project_dir):
-    history_dict = {"iterations": []}
+# LLM backends. The provider stack (litellm pulls in openai, tiktoken, tokenizers,
+# huggingface-hub and aiohttp) is imported the first time a build needs it, so serving
+# pages never waits for it. LLM_BACKEND may name another class with the same methods.
+class LLMBackend:
+    def load(self):
+        pass
+
+    def completion(self, **kwargs):
+        raise NotImplementedError
+
+    async def acompletion(self, **kwargs):
+        return await asyncio.to_thread(self.completion, **kwargs)
+
+    def supports_function_calling(self, model):
+        return True
+
+    def model_response(self, **data):
+        raise NotImplementedError
+
+    def is_rate_limit(self, error):
+        return False
+
+class LiteLLMBackend(LLMBackend):
+    def __init__(self):
+        self.litellm = None
+
+    def load(self):
+        if self.litellm is None:
+            self.litellm = importlib.import_module("litellm")
+        return self.litellm
+
+    def completion(self, **kwargs):
+        return self.load().completion(**kwargs)
+
+    async def acompletion(self, **kwargs):
+        return await self.load().acompletion(**kwargs)
+
+    def supports_function_calling(self, model):
+        return self.load().supports_function_calling(model)
+
+    def model_response(self, **data):
+        return self.load().ModelResponse(**data)
+
+    def is_rate_limit(self, error):
+        return isinstance(error, self.load().RateLimitError)
+
+backend = None
+backend_lock = Lock()
+function_calling_support = {}
+
+def llm_backend():
+    # Created and loaded once; concurrent first callers wait for the same import
+    global backend
+    if backend is not None:
+        return backend
+    with backend_lock:
+        if backend is None:
+            if LLM_BACKEND == "litellm":
+                instance = LiteLLMBackend()
+            else:
+                module_name, _, class_name = LLM_BACKEND.partition(":")
+                instance = getattr(importlib.import_module(module_name), class_name)()
+            instance.load()
+            backend = instance
+        return backend
+
+def preload_backend(warm_tokenizer=False):
+    # Starts the import in the background; callers that need the backend block on the lock
+    def load():
+        try:
+            llm_backend()
+            if warm_tokenizer:
+                get_encoding(MODEL_NAME)
+        except Exception as e:
+            pass  # Reported by the first build that needs the backend
+    if backend is None or warm_tokenizer:
+        Thread(target=load, name="llm-backend-loader", daemon=True).start()
+
+def completion(**kwargs):
+    return llm_backend().completion(**kwargs)
+
+async def acompletion(**kwargs):
+    if backend is None:
+        await asyncio.to_thread(llm_backend)  # Keep the import off the event loop
+    return await backend.acompletion(**kwargs)
+
+def supports_function_calling(model):
+    supported = function_calling_support.get(model)
+    if supported is None:
+        supported = function_calling_support[model] = llm_backend().supports_function_calling(model)
+    return supported
+
+def model_response(**data):
+    return llm_backend().model_response(**data)
+
+def is_rate_limit(error):
+    return llm_backend().is_rate_limit(error)
+
+# Content-addressed, disk-backed LLM response cache
+class CacheMiss(Exception):
+    pass
+
+class ResponseCache:
+    def __init__(self, directory=CACHE_DIR, mode=LLM_CACHE_MODE, max_bytes=LLM_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.total_bytes = None
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def key(self, request):
+        payload = {
+            "model": request.get("model"),
+            "messages": [message_to_dict(message) for message in request.get("messages") or []],
+            "tools": request.get("tools"),
+            "tool_choice": request.get("tool_choice")
+        }
+        canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as cache_file:
+                data = json.load(cache_file)
+            os.utime(path)  # mtime doubles as the LRU timestamp
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        encoded = json.dumps(data, default=str).encode("utf-8")
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as cache_file:
+            cache_file.write(encoded)
+        os.replace(temp_path, path)
+        with self.lock:
+            self.stores += 1
+            if self.total_bytes is None:
+                self.total_bytes = self.disk_usage()
+            else:
+                self.total_bytes += len(encoded)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def disk_usage(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def entries(self):
+        for root, dirs, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith(".json"):
+                    path = os.path.join(root, filename)
+                    try:
+                        info = os.stat(path)
+                    except OSError:
+                        continue
+                    yield info.st_mtime, info.st_size, path
+
+    def evict(self):
+        # Drop least recently used entries until the cache is back under 90% of its size limit
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+        self.total_bytes = total
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "mode": self.mode,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes
+            }
+
+def serialize_response(response):
+    if hasattr(response, 'model_dump'):
+        return response.model_dump()
+    return response.dict()
+
+response_cache = ResponseCache()
+
+def cache_lookup(kwargs):
+    # "on" reads through the cache, "record" always calls the provider and stores the
+    # response, "replay" serves only from the cache and fails on a miss.
+    mode = response_cache.mode
+    if mode not in ("on", "record", "replay"):
+        return None, None
+    key = response_cache.key(kwargs)
+    if mode in ("on", "replay"):
+        data = response_cache.get(key)
+        if data is not None:
+            response = model_response(**data)
+            mark_cache_hit(response)
+            return key, response
+        if mode == "replay":
+            raise CacheMiss(f"No cached LLM response for request {key} (LLM_CACHE=replay)")
+    return key, None
+
+def mark_cache_hit(response):
+    # The same flag litellm sets on responses from its own cache; a new dict, in case the
+    # default is shared
+    response._hidden_params = dict(getattr(response, "_hidden_params", None) or {}, cache_hit=True)
+
+def is_cache_hit(response):
+    hidden = getattr(response, "_hidden_params", None)
+    return isinstance(hidden, dict) and bool(hidden.get("cache_hit"))
+
+def cache_store(key, response):
+    if key is None:
+        return
+    try:
+        response_cache.put(key, serialize_response(response))
+    except Exception as e:
+        pass  # Caching is best effort
+
+def cached_completion(**kwargs):
+    model = kwargs.get("model")
+    start = perf_counter()
+    key, response = cache_lookup(kwargs)
+    if response is not None:
+        LLM_LATENCY.observe(perf_counter() - start, model, "cache")
+        return response
+    start = perf_counter()
+    try:
+        response = completion(**kwargs)
+    except Exception as e:
+        LLM_ERRORS.inc(model, type(e).__name__)
+        raise
+    LLM_LATENCY.observe(perf_counter() - start, model, "provider")
+    record_usage(model, response)
+    cache_store(key, response)
+    return response
+
+async def cached_acompletion(**kwargs):
+    model = kwargs.get("model")
+    start = perf_counter()
+    key, response = await asyncio.to_thread(cache_lookup, kwargs)
+    if response is not None:
+        LLM_LATENCY.observe(perf_counter() - start, model, "cache")
+        return response
+    start = perf_counter()
+    try:
+        response = await acompletion(**kwargs)
+    except Exception as e:
+        LLM_ERRORS.inc(model, type(e).__name__)
+        raise
+    LLM_LATENCY.observe(perf_counter() - start, model, "provider")
+    record_usage(model, response)
+    await asyncio.to_thread(cache_store, key, response)
+    return response
+
+# Rate-limit aware retries around completion()
+def retry_after_seconds(error):
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        value = headers.get('retry-after-ms')
+        if value is not None:
+            return float(value) / 1000
+        value = headers.get('retry-after')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except Exception:
+        return None
+
+def error_backoff(attempt):
+    delay = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** (attempt - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+def rate_limit_delay(error, attempt):
+    if attempt > LLM_MAX_RETRIES:
+        return None
+    delay = retry_after_seconds(error)
+    if delay is None:
+        delay = error_backoff(attempt)
+    return min(delay, LLM_BACKOFF_MAX)
+
+def completion_with_backoff(cancel_event=None, **kwargs):
+    attempt = 0
+    while True:
+        try:
+            return cached_completion(**kwargs)
+        except Exception as e:
+            if not is_rate_limit(e):
+                raise
+            attempt += 1
+            delay = rate_limit_delay(e, attempt)
+            if delay is None:
+                raise
+            if cancel_event is not None:
+                if cancel_event.wait(delay):
+                    raise
+            else:
+                sleep(delay)
+
+async def acompletion_with_backoff(cancel_event=None, timeout=LLM_TIMEOUT, **kwargs):
+    attempt = 0
+    while True:
+        try:
+            async with llm_request_slot():
+                return await asyncio.wait_for(cached_acompletion(**kwargs), timeout)
+        except Exception as e:
+            if not is_rate_limit(e):
+                raise
+            attempt += 1
+            delay = rate_limit_delay(e, attempt)
+            if delay is None:
+                raise
+            if await wait_cancellable(cancel_event, delay):
+                raise
+
+async def wait_cancellable(cancel_event, delay):
+    # Sleeps in short slices so a cancel from another thread is noticed promptly
+    deadline = time() + delay
+    while True:
+        if cancel_event is not None and cancel_event.is_set():
+            return True
+        remaining = deadline - time()
+        if remaining <= 0:
+            return False
+        await asyncio.sleep(min(remaining, 0.5))
+
+# Model routing: every call names a route (the call type), and each route has its own
+# model, ordered fallbacks tried on errors and timeouts, and optional hedging. Once a
+# route has enough latency samples, a request still running past the configured
+# percentile gets a duplicate sent to the hedge model, and the first answer wins.
+LLM_ROUTES = ("tools", "narrate", "plan", "generate")
+LLM_HEDGE_PERCENTILE = float(os.environ.get('LLM_HEDGE_PERCENTILE', '0'))  # e.g. 0.95; 0 disables hedging
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get('LLM_HEDGE_MIN_SAMPLES', '20'))
+LLM_ROUTE_WINDOW = int(os.environ.get('LLM_ROUTE_WINDOW', '200'))
+
+LLM_ROUTE_REQUESTS = metrics.register(Counter("ditto_llm_route_requests_total", "LLM requests per route and model.", ("route", "model", "outcome")))
+LLM_HEDGES = metrics.register(Counter("ditto_llm_hedges_total", "Hedged LLM requests per route and the attempt that answered first.", ("route", "winner")))
+
+# Primaries and hedges have separate pools, so a hedge never queues behind the requests it
+# is racing. The callers are the build workers and the fan-out workers, and each can leave
+# one losing attempt running in the background, hence two threads per caller.
+LLM_CALLERS = MAX_CONCURRENT_BUILDS + FANOUT_WORKERS
+primary_executor = ThreadPoolExecutor(max_workers=2 * LLM_CALLERS, thread_name_prefix="llm-primary")
+hedge_executor = ThreadPoolExecutor(max_workers=2 * LLM_CALLERS, thread_name_prefix="hedge")
+
+def env_models(name, default):
+    value = os.environ.get(name)
+    if not value:
+        return default
+    return [model.strip() for model in value.split(",") if model.strip()]
+
+def latency_percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class ModelRoute:
+    def __init__(self, name):
+        key = name.upper()
+        self.name = name
+        self.model = os.environ.get(f'LLM_MODEL_{key}', MODEL_NAME)
+        self.fallbacks = env_models(f'LLM_FALLBACKS_{key}', env_models('LLM_FALLBACKS', []))
+        self.hedge_model = os.environ.get(f'LLM_HEDGE_MODEL_{key}', os.environ.get('LLM_HEDGE_MODEL', self.model))
+        self.hedge_percentile = float(os.environ.get(f'LLM_HEDGE_PERCENTILE_{key}', LLM_HEDGE_PERCENTILE))
+        self.lock = Lock()
+        self.latencies = {}
+        self.counts = {}
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def models(self):
+        return [self.model] + [model for model in self.fallbacks if model != self.model]
+
+    def record(self, model, seconds, outcome):
+        with self.lock:
+            if outcome == "ok":
+                self.latencies.setdefault(model, deque(maxlen=LLM_ROUTE_WINDOW)).append(seconds)
+            counts = self.counts.setdefault(model, {"ok": 0, "error": 0})
+            counts[outcome] += 1
+        LLM_ROUTE_REQUESTS.inc(self.name, model, outcome)
+
+    def record_hedge(self, winner):
+        with self.lock:
+            self.hedges += 1
+            if winner == "hedge":
+                self.hedge_wins += 1
+        LLM_HEDGES.inc(self.name, winner)
+
+    def hedge_delay(self):
+        # None until the primary model has enough samples to estimate the percentile
+        if self.hedge_percentile <= 0:
+            return None
+        with self.lock:
+            samples = list(self.latencies.get(self.model, ()))
+        if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return latency_percentile(samples, self.hedge_percentile)
+
+    def stats(self):
+        with self.lock:
+            models = {}
+            for model in set(self.latencies) | set(self.counts):
+                samples = list(self.latencies.get(model, ()))
+                models[model] = dict(self.counts.get(model, {}), samples=len(samples))
+                if samples:
+                    models[model].update({f"p{int(fraction * 100)}": latency_percentile(samples, fraction) for fraction in (0.5, 0.9, 0.95, 0.99)})
+            hedges, hedge_wins = self.hedges, self.hedge_wins
+        return {
+            "model": self.model,
+            "fallbacks": self.fallbacks,
+            "hedge_model": self.hedge_model,
+            "hedge_percentile": self.hedge_percentile,
+            "hedge_after_seconds": self.hedge_delay(),
+            "hedges": hedges,
+            "hedge_wins": hedge_wins,
+            "models": models
+        }
+
+model_routes = {name: ModelRoute(name) for name in LLM_ROUTES}
+
+def timed_completion(route, model, cancel_event, kwargs):
+    start = perf_counter()
+    try:
+        response = completion_with_backoff(cancel_event, model=model, timeout=LLM_TIMEOUT, **kwargs)
+    except Exception as e:
+        route.record(model, perf_counter() - start, "error")
+        raise
+    route.record(model, perf_counter() - start, "ok")
+    return response
+
+def hedged_completion(route, cancel_event, kwargs):
+    delay = route.hedge_delay()
+    if delay is None:
+        return timed_completion(route, route.model, cancel_event, kwargs)
+    primary = primary_executor.submit(copy_context().run, timed_completion, route, route.model, cancel_event, kwargs)
+    done, _ = wait_futures([primary], timeout=delay)
+    if done:
+        return primary.result()
+    # The slower attempt cannot be interrupted; it finishes in the background and only feeds the stats
+    hedge = hedge_executor.submit(copy_context().run, timed_completion, route, route.hedge_model, cancel_event, kwargs)
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait_futures(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                route.record_hedge("hedge" if future is hedge else "primary")
+                return future.result()
+            error = future.exception()
+    raise error
+
+def routed_completion(cancel_event=None, route="tools", **kwargs):
+    route = model_routes[route]
+    error = None
+    for index, model in enumerate(route.models()):
+        try:
+            if index == 0:
+                return hedged_completion(route, cancel_event, kwargs)
+            return timed_completion(route, model, cancel_event, kwargs)
+        except CacheMiss:
+            raise
+        except Exception as e:
+            error = e
+            if cancel_event is not None and cancel_event.is_set():
+                break
+    raise error
+
+async def atimed_completion(route, model, cancel_event, kwargs):
+    start = perf_counter()
+    try:
+        response = await acompletion_with_backoff(cancel_event, model=model, **kwargs)
+    except Exception as e:
+        route.record(model, perf_counter() - start, "error")
+        raise
+    route.record(model, perf_counter() - start, "ok")
+    return response
+
+async def ahedged_completion(route, cancel_event, kwargs):
+    delay = route.hedge_delay()
+    if delay is None:
+        return await atimed_completion(route, route.model, cancel_event, kwargs)
+    primary = asyncio.ensure_future(atimed_completion(route, route.model, cancel_event, kwargs))
+    pending = {primary}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if done:
+            return primary.result()
+        hedge = asyncio.ensure_future(atimed_completion(route, route.hedge_model, cancel_event, kwargs))
+        pending.add(hedge)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    route.record_hedge("hedge" if task is hedge else "primary")
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def arouted_completion(cancel_event=None, route="tools", **kwargs):
+    route = model_routes[route]
+    error = None
+    for index, model in enumerate(route.models()):
+        try:
+            if index == 0:
+                return await ahedged_completion(route, cancel_event, kwargs)
+            return await atimed_completion(route, model, cancel_event, kwargs)
+        except CacheMiss:
+            raise
+        except Exception as e:
+            error = e
+            if cancel_event is not None and cancel_event.is_set():
+                break
+    raise error
+
+# Token-budgeted context compaction
+FILE_WRITE_TOOLS = {"create_file", "update_file"}
+FILE_EDIT_TOOLS = {"edit_file"}
+FILE_READ_TOOLS = {"fetch_code"}
+FILE_BATCH_READ_TOOLS = {"fetch_files"}
+# Section boundaries in a fetch_files result, and the headers of sections that carry a file body
+FETCH_BOUNDARY = re.compile(r'^(?:=== .* ===|\[not returned, .*)$', re.M)
+FETCH_HEADER = re.compile(r'=== (.+) \(version \d+, \d+ lines\) ===')
+SUMMARY_HEADER = "Summary of earlier iterations (older messages were compacted to stay within the context budget):"
+MAX_SUMMARY_LINES = 200
+
+def message_to_dict(message):
+    if isinstance(message, dict):
+        return message
+    data = {"role": getattr(message, 'role', None) or "assistant", "content": message.content}
+    tool_calls = getattr(message, 'tool_calls', None)
+    if tool_calls:
+        data["tool_calls"] = [
+            {
+                "id": tool_call.id,
+                "type": "function",
+                "function": {"name": tool_call.function.name, "arguments": tool_call.function.arguments}
+            }
+            for tool_call in tool_calls
+        ]
+    return data
+
+class ApproximateEncoding:
+    # Used when tiktoken cannot load an encoding (it downloads the BPE file on first use,
+    # which fails offline); about four characters per token is close enough for a budget
+    def encode(self, text, disallowed_special=()):
+        return range((len(text) + 3) // 4)
+
+encodings = {}
+
+def get_encoding(model):
+    encoding = encodings.get(model)
+    if encoding is None:
+        try:
+            import tiktoken
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            encoding = ApproximateEncoding()
+        encodings[model] = encoding
+    return encoding
+
+def fetch_sections(content):
+    # (path, body start, body end) for each file body in a fetch_files result
+    boundaries = list(FETCH_BOUNDARY.finditer(content))
+    sections = []
+    for number, boundary in enumerate(boundaries):
+        header = FETCH_HEADER.fullmatch(boundary.group(0))
+        if header is None:
+            continue
+        body_start = min(boundary.end() + 1, len(content))
+        body_end = boundaries[number + 1].start() - 1 if number + 1 < len(boundaries) else len(content)
+        sections.append((header.group(1), body_start, max(body_start, body_end)))
+    return sections
+
+def parse_arguments(arguments):
+    try:
+        parsed = json.loads(arguments or "{}")
+        return parsed if isinstance(parsed, dict) else {}
+    except ValueError:
+        return {}
+
+def first_line(text, limit=160):
+    line = (text or "").strip().splitlines()[0] if (text or "").strip() else ""
+    return line if len(line) <= limit else line[:limit] + "..."
+
+class ContextManager:
+    def __init__(self, budget=CONTEXT_TOKEN_BUDGET, keep_recent_turns=CONTEXT_KEEP_RECENT_TURNS, model=MODEL_NAME):
+        self.budget = budget
+        self.keep_recent_turns = keep_recent_turns
+        self.model = model
+        self.encoding = None
+        self.token_cache = {}
+        self.tokens_saved = 0
+
+    def count_text(self, text):
+        if not text:
+            return 0
+        count = self.token_cache.get(text)
+        if count is None:
+            if self.encoding is None:
+                self.encoding = get_encoding(self.model)
+            count = len(self.encoding.encode(text, disallowed_special=()))
+            self.token_cache[text] = count
+        return count
+
+    def count_message(self, message):
+        tokens = 4 + self.count_text(message.get("content"))
+        for tool_call in message.get("tool_calls") or []:
+            tokens += self.count_text(tool_call["function"]["name"]) + self.count_text(tool_call["function"]["arguments"])
+        return tokens
+
+    def count(self, messages):
+        return sum(self.count_message(message) for message in messages)
+
+    def compact(self, messages):
+        before = self.count(messages)
+        if before <= self.budget:
+            return None
+
+        superseded = self.replace_superseded(messages)
+        summarized = 0
+        if self.count(messages) > self.budget:
+            summarized = self.summarize_old_turns(messages)
+
+        after = self.count(messages)
+        if after >= before:
+            return None
+        self.tokens_saved += before - after
+        # Only texts still referenced by messages are worth keeping counts for
+        live = set()
+        for message in messages:
+            live.add(message.get("content"))
+            for tool_call in message.get("tool_calls") or []:
+                live.add(tool_call["function"]["arguments"])
+        self.token_cache = {text: count for text, count in self.token_cache.items() if text in live}
+        return {
+            "before": before,
+            "after": after,
+            "saved": before - after,
+            "superseded": superseded,
+            "summarized_turns": summarized
+        }
 
-    if not supports_function_calling(MODEL_NAME):
-        progress["status"] = "error"
-        progress["output"] = "Model does not support function calling."
-        progress["completed"] = True
+    def replace_superseded(self, messages):
+        # Every write argument or fetch result carries a full file body; only the most
+        # recent one per path is current, the rest become short references to it. A later
+        # edit_file makes every earlier body stale, and the model is told to fetch the file.
+        carriers = {}
+        tool_calls_by_id = {}
+        for index, message in enumerate(messages):
+            for position, tool_call in enumerate(message.get("tool_calls") or []):
+                name = tool_call["function"]["name"]
+                args = parse_arguments(tool_call["function"]["arguments"])
+                tool_calls_by_id[tool_call["id"]] = (name, args)
+                if name in FILE_WRITE_TOOLS and isinstance(args.get("path"), str) and "content" in args:
+                    carriers.setdefault(file_key(args["path"]), []).append(("write", index, position))
+            if message.get("role") == "tool":
+                name, args = tool_calls_by_id.get(message.get("tool_call_id"), (None, {}))
+                content = message.get("content") or ""
+                if name in FILE_READ_TOOLS and isinstance(args.get("file_path"), str):
+                    carriers.setdefault(file_key(args["file_path"]), []).append(("read", index, None))
+                elif name in FILE_BATCH_READ_TOOLS:
+                    for path, body_start, body_end in fetch_sections(content):
+                        carriers.setdefault(file_key(path), []).append(("section", index, (body_start, body_end)))
+                elif name in FILE_EDIT_TOOLS and isinstance(args.get("path"), str) and not content.startswith("Error"):
+                    carriers.setdefault(file_key(args["path"]), []).append(("edit", index, None))
+
+        replaced = 0
+        sections = {}
+        for path, entries in carriers.items():
+            if entries[-1][0] == "edit":
+                reason = "the file was edited later; fetch it for the current version"
+            else:
+                reason = "a later message holds the current version"
+                entries = entries[:-1]
+            for kind, index, where in entries:
+                message = messages[index]
+                if kind == "edit":
+                    continue
+                if kind == "write":
+                    tool_call = message["tool_calls"][where]
+                    args = parse_arguments(tool_call["function"]["arguments"])
+                    if str(args.get("content", "")).startswith("[superseded: "):
+                        continue
+                    args["content"] = f"[superseded: {reason} of {path}]"
+                    message = dict(message, tool_calls=list(message["tool_calls"]))
+                    message["tool_calls"][where] = dict(tool_call, function=dict(tool_call["function"], arguments=json.dumps(args)))
+                elif kind == "section":
+                    if not message["content"].startswith("[stale contents of ", where[0]):
+                        sections.setdefault(index, []).append((where, f"[stale contents of {path} omitted: {reason}]"))
+                    continue
+                elif (message.get("content") or "").startswith("[stale contents of "):
+                    continue
+                else:
+                    message = dict(message, content=f"[stale contents of {path} omitted: {reason}]")
+                messages[index] = message
+                replaced += 1
+        # fetch_files results hold several files; stale sections are cut back to front
+        for index, stale in sections.items():
+            content = messages[index]["content"]
+            for (body_start, body_end), note in sorted(stale, reverse=True):
+                content = content[:body_start] + note + content[body_end:]
+            messages[index] = dict(messages[index], content=content)
+            replaced += len(stale)
+        return replaced
+
+    def summarize_old_turns(self, messages):
+        prefix_end = next((index for index, message in enumerate(messages) if message.get("role") == "assistant"), len(messages))
+        prefix = messages[:prefix_end]
+        summary_lines = []
+        if prefix and prefix[-1].get("role") == "system" and (prefix[-1].get("content") or "").startswith(SUMMARY_HEADER):
+            summary_lines = prefix.pop()["content"].splitlines()[1:]
+
+        turns = []
+        for message in messages[prefix_end:]:
+            if message.get("role") == "assistant" or not turns:
+                turns.append([])
+            turns[-1].append(message)
+
+        # Compact below the budget so the next few iterations do not trigger another pass
+        target = int(self.budget * CONTEXT_COMPACT_TARGET)
+        summarized = 0
+        while len(turns) > self.keep_recent_turns:
+            summary_lines.extend(self.summarize_turn(turns.pop(0)))
+            summarized += 1
+            remaining = prefix + [{"role": "system", "content": ""}] + [message for turn in turns for message in turn]
+            if self.count(remaining) + sum(self.count_text(line) for line in summary_lines) <= target:
+                break
+
+        if not summarized:
+            return 0
+        if len(summary_lines) > MAX_SUMMARY_LINES:
+            summary_lines = ["- ..."] + summary_lines[-MAX_SUMMARY_LINES:]
+        summary = {"role": "system", "content": "\n".join([SUMMARY_HEADER] + summary_lines)}
+        messages[:] = prefix + [summary] + [message for turn in turns for message in turn]
+        return summarized
+
+    def summarize_turn(self, turn):
+        lines = []
+        calls = {}
+        for message in turn:
+            if message.get("role") == "assistant":
+                if message.get("content"):
+                    lines.append(f"- assistant: {first_line(message['content'])}")
+                for tool_call in message.get("tool_calls") or []:
+                    args = parse_arguments(tool_call["function"]["arguments"])
+                    target = args.get("path") or args.get("file_path") or ""
+                    calls[tool_call["id"]] = f"{tool_call['function']['name']}({target})"
+            elif message.get("role") == "tool":
+                call = calls.pop(message.get("tool_call_id"), message.get("name", "tool"))
+                lines.append(f"- {call} -> {first_line(message.get('content'))}")
+            else:
+                lines.append(f"- {message.get('role')}: {first_line(message.get('content'))}")
+        lines.extend(f"- {call} -> (no result)" for call in calls.values())
+        return lines
+
+# Parallel tool execution
+TOOL_WORKERS = int(os.environ.get('TOOL_WORKERS', '8'))
+PATH_ARGUMENTS = ("path", "file_path", "paths", "pattern")
+BARRIER_TOOLS = {"task_completed"}
+
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
+
+def tool_call_paths(function_args):
+    paths = []
+    for key in PATH_ARGUMENTS:
+        values = function_args.get(key)
+        for value in values if isinstance(values, list) else [values]:
+            if not isinstance(value, str):
+                continue
+            if key == "pattern":
+                # A glob touches everything under its first wildcard-free directory
+                value = value.split("*")[0].split("?")[0].split("[")[0]
+                job = current_job.get()
+                if not os.path.isabs(value) and job is not None:
+                    value = os.path.join(job.project_dir, value)
+                value = value if value.endswith(os.sep) or not value else os.path.dirname(value)
+            paths.append(os.path.normpath(os.path.abspath(value)))
+    return paths
+
+def paths_conflict(paths_a, paths_b):
+    for a in paths_a:
+        for b in paths_b:
+            if a == b or a.startswith(b + os.sep) or b.startswith(a + os.sep):
+                return True
+    return False
+
+def run_tool_call(call):
+    try:
+        with TOOL_LATENCY.time(call["name"]):
+            function_response = call["function"](**call["args"])
+        if isinstance(function_response, str) and function_response.startswith("Error"):
+            TOOL_ERRORS.inc(call["name"])
+        return {"tool_call": call["tool_call"], "name": call["name"], "response": function_response, "error": None}
+    except Exception as tool_error:
+        TOOL_ERRORS.inc(call["name"])
+        return {
+            "tool_call": call["tool_call"],
+            "name": call["name"],
+            "response": None,
+            "error": {
+                'action': f'tool_call_{call["name"]}',
+                'error': f"Error executing {call['name']}: {tool_error}",
+                'traceback': traceback.format_exc()
+            }
+        }
+
+def plan_tool_calls(tool_calls):
+    # Calls are grouped into waves: a call runs after every earlier call that touches the
+    # same path (or a parent/child of it), and barrier tools run after everything before them.
+    # Calls in the same wave are independent and can run concurrently.
+    results = [None] * len(tool_calls)
+    calls = []
+    for index, tool_call in enumerate(tool_calls):
+        function_name = tool_call.function.name
+        function_to_call = available_functions.get(function_name)
+        if not function_to_call:
+            results[index] = {
+                "tool_call": tool_call,
+                "name": function_name,
+                "response": None,
+                "error": {
+                    'action': f'tool_call_{function_name}',
+                    'error': f"Tool '{function_name}' is not available.",
+                    'traceback': 'No traceback available.'
+                }
+            }
+            continue
+        try:
+            function_args = json.loads(tool_call.function.arguments)
+        except Exception as e:
+            results[index] = {
+                "tool_call": tool_call,
+                "name": function_name,
+                "response": None,
+                "error": {
+                    'action': f'tool_call_{function_name}',
+                    'error': f"Error executing {function_name}: {e}",
+                    'traceback': traceback.format_exc()
+                }
+            }
+            continue
+
+        call = {
+            "index": index,
+            "tool_call": tool_call,
+            "name": function_name,
+            "function": function_to_call,
+            "args": function_args,
+            "paths": tool_call_paths(function_args),
+            "wave": 0
+        }
+        if function_name in BARRIER_TOOLS:
+            call["wave"] = max((other["wave"] + 1 for other in calls), default=0)
+        else:
+            for other in calls:
+                if other["name"] in BARRIER_TOOLS or paths_conflict(call["paths"], other["paths"]):
+                    call["wave"] = max(call["wave"], other["wave"] + 1)
+        calls.append(call)
+        if function_name in BARRIER_TOOLS:
+            # Nothing after the barrier runs, matching the sequential loop which returns on it
+            results = results[:index + 1]
+            break
+
+    waves = {}
+    for call in calls:
+        waves.setdefault(call["wave"], []).append(call)
+    return results, [waves[wave] for wave in sorted(waves)]
+
+def execute_tool_calls(tool_calls):
+    results, waves = plan_tool_calls(tool_calls)
+    for batch in waves:
+        if len(batch) == 1:
+            results[batch[0]["index"]] = run_tool_call(batch[0])
+            continue
+        futures = [(call["index"], tool_executor.submit(copy_context().run, run_tool_call, call)) for call in batch]
+        for index, future in futures:
+            results[index] = future.result()
+    return results
+
+async def execute_tool_calls_async(tool_calls):
+    # File tools run in worker threads (asyncio.to_thread copies the job context),
+    # so the event loop never blocks on disk I/O.
+    results, waves = plan_tool_calls(tool_calls)
+    for batch in waves:
+        batch_results = await asyncio.gather(*(asyncio.to_thread(run_tool_call, call) for call in batch))
+        for call, result in zip(batch, batch_results):
+            results[call["index"]] = result
+    return results
+
+# Plan-then-fan-out generation: one planning call returns a manifest of every file and
+# its interface, the files are then generated concurrently against that manifest, and the
+# regular tool loop runs afterwards as the integration and review pass.
+FANOUT_MAX_FILES = int(os.environ.get('FANOUT_MAX_FILES', '40'))
+CODE_FENCE = re.compile(r'^\s*```[\w.+-]*\n(.*?)\n?```\s*$', re.DOTALL)
+
+fanout_executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
+
+plan_tool = {
+    "type": "function",
+    "function": {
+        "name": "submit_plan",
+        "description": "Submits the manifest of every file the application needs.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "files": {
+                    "type": "array",
+                    "description": "Every file of the application, relative to the project directory.",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "path": {"type": "string", "description": "File path relative to the project directory, e.g. routes/auth.py."},
+                            "purpose": {"type": "string", "description": "What the file does."},
+                            "interface": {
+                                "type": "string",
+                                "description": "What other files rely on: blueprint names, endpoints and URLs, functions, template variables, blocks, CSS classes and element IDs."
+                            }
+                        },
+                        "required": ["path", "purpose", "interface"]
+                    }
+                },
+                "notes": {
+                    "type": "string",
+                    "description": "Conventions shared by all files (app factory, blueprint registration, base template, styling)."
+                }
+            },
+            "required": ["files"]
+        }
+    }
+}
+
+def run_completions(job, requests):
+    # Sync counterpart of asyncio.gather(..., return_exceptions=True)
+    futures = [fanout_executor.submit(copy_context().run, routed_completion, job.cancel_event, **kwargs) for kwargs in requests]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(e)
+    return results
+
+def parse_plan(response, project_dir):
+    message = response.choices[0].message
+    arguments = None
+    for tool_call in message.tool_calls or []:
+        if tool_call.function.name == "submit_plan":
+            arguments = parse_arguments(tool_call.function.arguments)
+    if arguments is None:
+        arguments = parse_arguments(strip_code_fence(message.content or ""))
+    files = []
+    seen = set()
+    for entry in arguments.get("files") or []:
+        if not isinstance(entry, dict) or not isinstance(entry.get("path"), str):
+            continue
+        relative = os.path.normpath(entry["path"].strip().lstrip("/"))
+        if relative in seen or not safe_join(project_dir, relative):
+            continue
+        seen.add(relative)
+        files.append({"path": relative, "purpose": str(entry.get("purpose", "")), "interface": str(entry.get("interface", ""))})
+    return {"files": files[:FANOUT_MAX_FILES], "notes": str(arguments.get("notes") or "")}
+
+def strip_code_fence(text):
+    match = CODE_FENCE.match(text)
+    return match.group(1) if match else text
+
+def local_tool_call(name, arguments):
+    return SimpleNamespace(id=f"local-{uuid.uuid4().hex[:12]}", function=SimpleNamespace(name=name, arguments=json.dumps(arguments)))
+
+def file_request(user_input, plan, spec):
+    manifest = json.dumps(plan, indent=2)
+    return {
+        "route": "generate",
+        "messages": [
+            {
+                "role": "system",
+                "content": (
+                    "You are an expert Flask developer writing one file of a Flask application. Other developers are writing the other files "
+                    "at the same time from the same manifest, so follow the manifest's paths, names and interfaces exactly.\n"
+                    "Reply with the complete contents of the file and nothing else: no explanations and no Markdown fences. "
+                    "Do not use placeholders; the code must be complete and functional.\n\n"
+                    f"Manifest:\n{manifest}"
+                )
+            },
+            {"role": "user", "content": f"Application description:\n{user_input}\n\nWrite {spec['path']}.\nPurpose: {spec['purpose']}\nInterface: {spec['interface']}"}
+        ]
+    }
+
+def fanout_steps(user_input, project_dir, job, build_log, messages):
+    # Returns True when the files were generated and messages now hold the integration request;
+    # on a planning failure the build continues in the iterative loop with messages unchanged.
+    job.update_progress(phase="planning")
+    job.emit("\n<h3>Planning</h3>\n")
+    try:
+        response = yield ("completion", {
+            "route": "plan",
+            "messages": [
+                {
+                    "role": "system",
+                    "content": (
+                        "You are an expert Flask developer planning a complete, production-ready Flask application. "
+                        "List every file it needs: the app entry point, modular routes in `routes/` (one blueprint per file), "
+                        "templates in `templates/` and static assets in `static/`. For each file describe its purpose and the interface "
+                        "other files rely on, precisely enough that each file can be written independently. Submit the plan with `submit_plan`."
+                    )
+                },
+                {"role": "user", "content": user_input}
+            ],
+            "tools": [plan_tool],
+            "tool_choice": {"type": "function", "function": {"name": "submit_plan"}}
+        })
+        account_usage(job, build_log, 0, "plan", response)
+        plan = parse_plan(response, project_dir)
+    except CacheMiss:
+        raise
+    except Exception as e:
+        plan = {"files": []}
+        log_event(build_log, "error", 0, action='plan', error=str(e), traceback=traceback.format_exc())
+    if not plan["files"]:
+        job.emit("<em>No usable plan; building step by step instead.</em>\n")
+        job.update_progress(phase="iterating")
+        return False
+
+    log_event(build_log, "plan", 0, files=[spec["path"] for spec in plan["files"]], notes=plan["notes"])
+    job.emit("<strong>Plan:</strong>\n<p>" + ", ".join(spec["path"] for spec in plan["files"]) + "</p>\n")
+    job.update_progress(phase="generating")
+
+    responses = yield ("completions", [file_request(user_input, plan, spec) for spec in plan["files"]])
+    writes = []
+    failed = []
+    for spec, response in zip(plan["files"], responses):
+        content = None
+        if not isinstance(response, Exception):
+            account_usage(job, build_log, 0, "generate", response)
+        if not isinstance(response, Exception) and response.choices and response.choices[0].message:
+            content = strip_code_fence(response.choices[0].message.content or "")
+        if not content:
+            failed.append(spec["path"])
+            error = str(response) if isinstance(response, Exception) else "empty response"
+            log_event(build_log, "error", 0, action=f'generate_{spec["path"]}', error=error)
+            continue
+        writes.append(local_tool_call("create_file", {"path": os.path.join(project_dir, spec["path"]), "content": content}))
+
+    # Parent directories go in the same batch; the path ordering runs them before their files
+    directories = sorted({os.path.dirname(json.loads(write.function.arguments)["path"]) for write in writes} - {project_dir})
+    generated = []
+    results = yield ("tools", [local_tool_call("create_directory", {"path": directory}) for directory in directories] + writes)
+    for result in results:
+        if result["name"] != "create_file":
+            continue
+        path = os.path.relpath(json.loads(result["tool_call"].function.arguments)["path"], project_dir)
+        if result["error"] or result["response"].startswith("Error"):
+            failed.append(path)
+            log_event(build_log, "error", 0, **(result["error"] or {"action": "tool_call_create_file", "error": result["response"]}))
+            continue
+        generated.append(path)
+        log_event(build_log, "tool_result", 0, tool="create_file", result=result["response"])
+    diagnostics = yield ("validate", None)
+    # The files were written by local tool calls; the model in the tool loop has not seen them yet
+    job.files.forget_delivered([os.path.join(project_dir, path) for path in generated])
+    log_event(build_log, "fanout", 0, generated=generated, failed=failed)
+    job.emit(f"<strong>Generated {len(generated)} files in parallel</strong>" + (f" ({len(failed)} failed: {', '.join(failed)})" if failed else "") + "\n")
+    job.update_progress(phase="integrating")
+
+    summary = "\n".join(f"- {spec['path']}: {spec['purpose']}" for spec in plan["files"])
+    messages.append({
+        "role": "user",
+        "content": (
+            f"The files below were generated in parallel from this plan, each without seeing the others:\n{summary}\n"
+            + (f"These files could not be generated and still need to be created: {', '.join(failed)}\n" if failed else "")
+            + (f"{diagnostics}\n" if diagnostics else "")
+            + "Review them together with `fetch_files`, fix inconsistencies between them (imports, blueprint registration, url_for endpoints, "
+            "template names and blocks, static references) with `edit_file`, create anything missing, then call `task_completed()`."
+        )
+    })
+    return True
+
+# Incremental validation: after each tool batch the Python files and templates that changed
+# are analysed in a process pool (syntax, plus the names they define and reference), and the
+# cached per-file facts are cross-checked for url_for endpoints, templates, static assets and
+# project imports. Only problems not reported before are sent back to the model.
+VALIDATE_WRITES = os.environ.get('VALIDATE_WRITES', '1') == '1'
+VALIDATION_WORKERS = int(os.environ.get('VALIDATION_WORKERS', '2'))
+VALIDATION_MAX_DIAGNOSTICS = int(os.environ.get('VALIDATION_MAX_DIAGNOSTICS', '20'))
+# Small batches are analysed in-process; shipping them to a worker costs more than the parse
+VALIDATION_INLINE_BYTES = int(os.environ.get('VALIDATION_INLINE_BYTES', '16384'))
+ROUTE_DECORATORS = {"route", "get", "post", "put", "patch", "delete"}
+FLASK_REFERENCE = re.compile(r'url_for|render_template|Blueprint|import|\.(?:route|get|post|put|patch|delete)\(')
+STATIC_REFERENCE = re.compile(r'(?:src|href)\s*=\s*["\']/static/([^"\'?#{]+)')
+
+validation_pool = None
+validation_pool_lock = Lock()
+
+def get_validation_pool():
+    global validation_pool
+    with validation_pool_lock:
+        if validation_pool is None:
+            # Forking a process this busy with threads can copy a lock some other thread holds;
+            # workers start from a clean interpreter instead
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            validation_pool = ProcessPoolExecutor(max_workers=VALIDATION_WORKERS, mp_context=multiprocessing.get_context(method))
+        return validation_pool
+
+def call_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    return None
+
+def constant_string(node):
+    return node.value if isinstance(node, ast.Constant) and isinstance(node.value, str) else None
+
+def analyze_python(path, content):
+    facts = {"errors": [], "names": [], "endpoints": [], "url_for": [], "static": [], "templates": [], "imports": []}
+    try:
+        code = compile(content, path, 'exec')
+    except SyntaxError as e:
+        facts["errors"].append(f"{path}:{e.lineno}: SyntaxError: {e.msg}")
+        return facts
+    if not FLASK_REFERENCE.search(content):
+        # Nothing to cross-reference; the code object's names cover what other modules can import
+        facts["names"] = list(code.co_names)
+        return facts
+    tree = ast.parse(content, path)
+    blueprints = {}
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            facts["names"].append(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            facts["names"].extend((alias.asname or alias.name).split(".")[0] for alias in node.names)
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            facts["names"].extend(target.id for target in targets if isinstance(target, ast.Name))
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign):
+            targets = [target.id for target in node.targets if isinstance(target, ast.Name)]
+            if isinstance(node.value, ast.Call) and call_name(node.value.func) == "Blueprint" and node.value.args:
+                name = constant_string(node.value.args[0])
+                if name:
+                    blueprints.update((target, name) for target in targets)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            for decorator in node.decorator_list:
+                if not (isinstance(decorator, ast.Call) and isinstance(decorator.func, ast.Attribute) and decorator.func.attr in ROUTE_DECORATORS):
+                    continue
+                endpoint = next((constant_string(keyword.value) for keyword in decorator.keywords if keyword.arg == "endpoint"), None) or node.name
+                owner = decorator.func.value.id if isinstance(decorator.func.value, ast.Name) else None
+                facts["endpoints"].append(f"{blueprints[owner]}.{endpoint}" if owner in blueprints else endpoint)
+        elif isinstance(node, ast.Call) and node.args:
+            name = call_name(node.func)
+            target = constant_string(node.args[0])
+            if not target:
+                continue
+            if name == "url_for":
+                if target == "static":
+                    filename = next((constant_string(keyword.value) for keyword in node.keywords if keyword.arg == "filename"), None)
+                    if filename:
+                        facts["static"].append((node.lineno, filename))
+                else:
+                    if target.startswith(".") and len(set(blueprints.values())) == 1:
+                        target = next(iter(blueprints.values())) + target
+                    facts["url_for"].append((node.lineno, target))
+            elif name == "render_template":
+                facts["templates"].append((node.lineno, target))
+        elif isinstance(node, ast.ImportFrom):
+            module = node.module or ""
+            if node.level:
+                base = os.path.dirname(path).split(os.sep) if os.path.dirname(path) else []
+                base = base[:len(base) - (node.level - 1)] if node.level > 1 else base
+                module = ".".join(base + ([module] if module else []))
+            facts["imports"].append((node.lineno, module, [alias.name for alias in node.names]))
+    return facts
+
+def analyze_template(path, content):
+    facts = {"errors": [], "names": [], "endpoints": [], "url_for": [], "static": [], "templates": [], "imports": []}
+    try:
+        tree = TemplateEnvironment().parse(content)
+    except TemplateSyntaxError as e:
+        facts["errors"].append(f"{path}:{e.lineno}: TemplateSyntaxError: {e.message}")
+        return facts
+    facts["templates"] = [(None, name) for name in template_meta.find_referenced_templates(tree) if name]
+    for node in tree.find_all(template_nodes.Call):
+        if not (isinstance(node.node, template_nodes.Name) and node.node.name == "url_for" and node.args):
+            continue
+        if not isinstance(node.args[0], template_nodes.Const) or not isinstance(node.args[0].value, str):
+            continue
+        target = node.args[0].value
+        if target == "static":
+            filename = next((keyword.value.value for keyword in node.kwargs
+                             if keyword.key == "filename" and isinstance(keyword.value, template_nodes.Const)), None)
+            if isinstance(filename, str):
+                facts["static"].append((node.lineno, filename))
+        else:
+            facts["url_for"].append((node.lineno, target))
+    for line_number, line in enumerate(content.splitlines(), 1):
+        facts["static"].extend((line_number, match) for match in STATIC_REFERENCE.findall(line))
+    return facts
+
+def analyze_file(path, content):
+    # Runs in a worker process; path is relative to the project directory
+    if path.endswith(".py"):
+        return analyze_python(path, content)
+    return analyze_template(path, content)
+
+VALIDATED_TEMPLATE_SUFFIXES = (".html", ".htm", ".jinja", ".j2", ".txt", ".xml")
+
+def is_validated(path):
+    return not path.startswith(os.pardir) and (path.endswith(".py") or (path.startswith("templates" + os.sep) and path.endswith(VALIDATED_TEMPLATE_SUFFIXES)))
+
+def module_name(path):
+    module = path[:-len(".py")].replace(os.sep, ".")
+    return module[:-len(".__init__")] if module.endswith(".__init__") else module
+
+# What references are checked against (routes, templates, static files and project modules)
+# and, in reverse, the files that refer to each of them. Kept up to date file by file, so a
+# batch only costs as much as the files it changed and the files that refer to them.
+class ValidationIndex:
+    def __init__(self):
+        self.provided = {("endpoint", "static"): 1}
+        self.provides = {}
+        self.references = {}
+        self.referrers = {}
+        self.modules = {}
+        self.versions = {}
+
+    def has(self, kind, name):
+        return (kind, name) in self.provided
+
+    def update(self, path, file_facts, present=True):
+        # Replaces what path provides and refers to; returns the symbols that appeared,
+        # disappeared or (for a module) changed
+        changed = set()
+        for symbol in self.provides.pop(path, ()):
+            if self.provided[symbol] == 1:
+                del self.provided[symbol]
+                changed.add(symbol)
+            else:
+                self.provided[symbol] -= 1
+        for symbol in self.references.pop(path, ()):
+            referrers = self.referrers[symbol]
+            referrers.discard(path)
+            if not referrers:
+                del self.referrers[symbol]
+        if path.endswith(".py") and self.modules.pop(module_name(path), None) is not None:
+            changed.add(("module", module_name(path)))
+        if not present:
+            return changed
+
+        provides = []
+        if os.sep in path:
+            provides.append(("package", path.split(os.sep)[0]))
+        for kind in ("templates", "static"):
+            if path.startswith(kind + os.sep):
+                provides.append((kind.rstrip("s"), path[len(kind + os.sep):].replace(os.sep, "/")))
+        references = set()
+        if file_facts is not None:
+            provides.extend(("endpoint", endpoint) for endpoint in file_facts["endpoints"])
+            if path.endswith(".py"):
+                module = module_name(path)
+                self.modules[module] = file_facts
+                provides.append(("module", module))
+                if os.sep not in path:
+                    provides.append(("package", module))
+                changed.add(("module", module))
+            references.update(("endpoint", endpoint) for _, endpoint in file_facts["url_for"])
+            references.update(("template", template.lstrip("/")) for _, template in file_facts["templates"])
+            references.update(("static", filename.lstrip("/")) for _, filename in file_facts["static"])
+            for _, module, names in file_facts["imports"]:
+                references.update((("module", module), ("package", module.split(".")[0])))
+                references.update(("module", f"{module}.{name}") for name in names)
+        for symbol in provides:
+            if symbol not in self.provided:
+                changed.add(symbol)
+            self.provided[symbol] = self.provided.get(symbol, 0) + 1
+        self.provides[path] = provides
+        for symbol in references:
+            self.referrers.setdefault(symbol, set()).add(path)
+        self.references[path] = references
+        return changed
+
+    def referencing(self, symbols):
+        paths = set()
+        for symbol in symbols:
+            paths.update(self.referrers.get(symbol, ()))
+        return paths
+
+def check_file(path, file_facts, index):
+    diagnostics = list(file_facts["errors"])
+    for line, endpoint in file_facts["url_for"]:
+        if not index.has("endpoint", endpoint) and not endpoint.startswith("."):
+            diagnostics.append(f"{path}:{line}: url_for('{endpoint}') does not match any route")
+    for line, template in file_facts["templates"]:
+        if not index.has("template", template.lstrip("/")):
+            diagnostics.append(f"{path}{f':{line}' if line else ''}: template '{template}' does not exist in templates/")
+    for line, filename in file_facts["static"]:
+        if not index.has("static", filename.lstrip("/")):
+            diagnostics.append(f"{path}:{line}: static file '{filename}' does not exist in static/")
+    modules = index.modules
+    for line, module, names in file_facts["imports"]:
+        if not index.has("package", module.split(".")[0]):
+            continue  # Not a project module
+        target = modules.get(module)
+        if target is None:
+            if not any(f"{module}.{name}" in modules for name in names):
+                diagnostics.append(f"{path}:{line}: module '{module}' does not exist in the project")
+            continue
+        if target["errors"]:
+            continue
+        for name in names:
+            if name != "*" and name not in target["names"] and f"{module}.{name}" not in modules:
+                diagnostics.append(f"{path}:{line}: '{name}' is not defined in {module}")
+    return diagnostics
+
+def validate_changes(job):
+    # Only files whose cached version changed since the last run are looked at (the tools
+    # are the only writers, as for the checkpoint manifest); the first run lists the project.
+    if not VALIDATE_WRITES:
+        return None
+    project_dir = os.path.abspath(job.project_dir)
+    staged = set(job.files.staged_paths())
+    index = job.validation_index
+    if index is None:
+        index = job.validation_index = ValidationIndex()
+        files, _ = get_project_index(project_dir).listing()
+        changed = set(files) | {os.path.relpath(key, project_dir) for key in staged}
+    else:
+        versions = job.files.versions()
+        changed = {os.path.relpath(key, project_dir) for key, version in versions.items() if index.versions.get(key) != version}
+        # Files a rollback took out of the cache
+        changed.update(os.path.relpath(key, project_dir) for key in index.versions if key not in versions)
+
+    symbols = set()
+    recheck = set()
+    pending = []
+    for path in sorted(changed):
+        if path.startswith(os.pardir):
+            continue
+        key = os.path.join(project_dir, path)
+        if not is_validated(path):
+            symbols |= index.update(path, None, key in staged or os.path.exists(key))
+            continue
+        try:
+            _, content = job.files.read(key)
+        except (OSError, UnicodeDecodeError):
+            if job.file_facts.pop(path, None) is not None:
+                symbols |= index.update(path, None, present=False)
+                recheck.add(path)
+            continue
+        digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        cached = job.file_facts.get(path)
+        if cached is None or cached[0] != digest:
+            pending.append((path, digest, content))
+    index.versions = job.files.versions()
+    if pending:
+        results = None
+        if sum(len(content) for _, _, content in pending) > VALIDATION_INLINE_BYTES:
+            try:
+                results = list(get_validation_pool().map(analyze_file, [path for path, _, _ in pending], [content for _, _, content in pending]))
+            except Exception as e:
+                pass  # A broken pool (e.g. a killed worker) should not stop the build
+        if results is None:
+            results = [analyze_file(path, content) for path, _, content in pending]
+        for (path, digest, _), facts in zip(pending, results):
+            job.file_facts[path] = (digest, facts)
+            symbols |= index.update(path, facts)
+            recheck.add(path)
+
+    for path in recheck | index.referencing(symbols):
+        diagnostics = check_file(path, job.file_facts[path][1], index) if path in job.file_facts else None
+        if diagnostics:
+            job.file_diagnostics[path] = diagnostics
+        else:
+            job.file_diagnostics.pop(path, None)
+
+    diagnostics = [diagnostic for path in sorted(job.file_diagnostics) for diagnostic in job.file_diagnostics[path]]
+    new = [diagnostic for diagnostic in diagnostics if diagnostic not in job.reported_diagnostics]
+    job.reported_diagnostics = set(diagnostics)
+    if not new:
+        return None
+    lines = [f"Validation found {len(new)} new problem(s)" + (f" ({len(diagnostics) - len(new)} reported earlier are still open)" if len(diagnostics) > len(new) else "") + ":"]
+    lines.extend(f"- {diagnostic}" for diagnostic in new[:VALIDATION_MAX_DIAGNOSTICS])
+    if len(new) > VALIDATION_MAX_DIAGNOSTICS:
+        lines.append(f"- ... and {len(new) - VALIDATION_MAX_DIAGNOSTICS} more")
+    return "\n".join(lines)
+
+def commit_files(job):
+    return job.files.flush()
+
+def start_build(job, user_input, project_dir):
+    token = current_job.set(job)
+    try:
+        build_log = BuildLog(job.log_path)
+    except BaseException:
+        current_job.reset(token)
+        raise
+    log_event(build_log, "start", 0, job_id=job.id, project_dir=project_dir, model=MODEL_NAME, user_input=user_input)
+    return token, build_log
+
+def fail_build(job, build_log, error):
+    log_event(build_log, "error", job.progress["iteration"], action='run_main_loop', error=str(error), traceback=traceback.format_exc())
+    job.emit(f"\n<strong>Error:</strong>\n<p>{error}</p>\n")
+    job.update_progress(status="error", completed=True)
+    return job.output()
+
+def abandon_build(job, error):
+    # For errors outside the build loop (e.g. the build log could not be opened), which
+    # would otherwise leave the job queued forever and take its worker down with it
+    if not job.finished:
+        job.emit(f"\n<strong>Error:</strong>\n<p>{error}</p>\n")
+        job.update_progress(status="error", completed=True)
+        BUILDS.inc("error")
+
+def finish_build(job, build_log, token):
+    # Writes still staged belong to an iteration that did not finish
+    job.files.rollback()
+    BUILDS.inc(job.progress["status"])
+    BUILD_ITERATIONS.observe(job.progress["iteration"])
+    if job.progress["status"] == "completed":
+        remove_checkpoint(job.id)
+    else:
+        save_checkpoint(job)
+    build_log.close()
+    job.events.close()
+    current_job.reset(token)
+
+def run_main_loop(user_input, project_dir, job=None):
+    if job is None:
+        job = Job(user_input, os.path.basename(project_dir), project_dir)
+    token, build_log = start_build(job, user_input, project_dir)
+    try:
+        try:
+            output = drive_steps(agent_steps(user_input, project_dir, job, build_log), job, build_log)
+        except Exception as e:
+            output = fail_build(job, build_log, e)
+        log_event(build_log, "finish", job.progress["iteration"], status=job.progress["status"])
+        return output
+    finally:
+        finish_build(job, build_log, token)
+
+def drive_steps(steps, job, build_log):
+    value, error = None, None
+    while True:
+        try:
+            kind, argument = steps.throw(error) if error is not None else steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+        value, error = None, None
+        try:
+            if kind == "completion":
+                value = routed_completion(job.cancel_event, **argument)
+            elif kind == "tools":
+                value = execute_tool_calls(argument)
+            elif kind == "completions":
+                value = run_completions(job, argument)
+            elif kind == "flush":
+                log_to_file(build_log)
+            elif kind == "checkpoint":
+                save_checkpoint(job, *argument)
+            elif kind == "validate":
+                value = validate_changes(job)
+            elif kind == "commit":
+                commit_files(job)
+            elif kind == "rollback":
+                job.files.rollback()
+            elif kind == "wait":
+                job.cancel_event.wait(argument)
+        except Exception as e:
+            error = e
+
+async def run_main_loop_async(user_input, project_dir, job=None):
+    if job is None:
+        job = Job(user_input, os.path.basename(project_dir), project_dir)
+    token, build_log = start_build(job, user_input, project_dir)
+    try:
+        try:
+            output = await drive_steps_async(agent_steps(user_input, project_dir, job, build_log), job, build_log)
+        except asyncio.CancelledError:
+            job.cancel()
+            job.emit("\n<h2>CANCELLED</h2>\n")
+            job.update_progress(status="cancelled", completed=True)
+            log_event(build_log, "finish", job.progress["iteration"], status="cancelled")
+            raise
+        except Exception as e:
+            output = fail_build(job, build_log, e)
+        log_event(build_log, "finish", job.progress["iteration"], status=job.progress["status"])
+        return output
+    finally:
+        finish_build(job, build_log, token)
+
+async def drive_steps_async(steps, job, build_log):
+    value, error = None, None
+    while True:
+        try:
+            kind, argument = steps.throw(error) if error is not None else steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+        value, error = None, None
+        try:
+            if kind == "completion":
+                value = await arouted_completion(job.cancel_event, **argument)
+            elif kind == "tools":
+                value = await execute_tool_calls_async(argument)
+            elif kind == "completions":
+                value = await asyncio.gather(*(arouted_completion(job.cancel_event, **kwargs) for kwargs in argument),
+                                             return_exceptions=True)
+            elif kind == "flush":
+                await asyncio.to_thread(log_to_file, build_log)
+            elif kind == "checkpoint":
+                await asyncio.to_thread(save_checkpoint, job, *argument)
+            elif kind == "validate":
+                value = await asyncio.to_thread(validate_changes, job)
+            elif kind == "commit":
+                await asyncio.to_thread(commit_files, job)
+            elif kind == "rollback":
+                job.files.rollback()
+            elif kind == "wait":
+                await wait_cancellable(job.cancel_event, argument)
+        except asyncio.CancelledError:
+            steps.close()
+            raise
+        except Exception as e:
+            error = e
+
+def account_usage(job, build_log, iteration, route, response):
+    # Per-response token split in the build log, running totals in the job's progress.
+    # Cached responses were not sent to the provider, so they are logged but not counted.
+    counts = usage_counts(response)
+    if not counts:
+        return
+    source = "cache" if is_cache_hit(response) else "provider"
+    log_event(build_log, "usage", iteration, route=route, source=source, **counts)
+    if source == "provider":
+        job.update_progress(tokens={kind: job.progress["tokens"][kind] + counts[kind] for kind in counts})
+
+# The system prompt and the tool schema are the same bytes for every build and come first,
+# so providers can serve them from their prompt cache; per-job details follow them.
+SYSTEM_PROMPT = (
+    "You are an expert Flask developer tasked with building a complete, production-ready Flask application based on the user's description. "
+    "Before coding, carefully plan out all the files, routes, templates, and static assets needed. "
+    "All files should be created within the project directory given in the next message.\n"
+    "Follow these steps:\n"
+    "1. **Understand the Requirements**: Analyze the user's input to fully understand the application's functionality and features.\n"
+    "2. **Plan the Application Structure**: List all the routes, templates, and static files that need to be created. Consider how they interact.\n"
+    "3. **Implement Step by Step**: For each component, use the provided tools to create directories, files, and write code. Ensure each step is thoroughly completed before moving on.\n"
+    "4. **Review and Refine**: Use `fetch_files` to review the code you've written, several files per call. Fix files with `edit_file`, or rewrite them with `update_file` when most of the file changes.\n"
+    "5. **Ensure Completeness**: Do not leave any placeholders or incomplete code. All functions, routes, and templates must be fully implemented and ready for production.\n"
+    "6. **Finalize**: Once everything is complete and thoroughly tested, call `task_completed()` to finish.\n\n"
+    "Constraints and Notes:\n"
+    "- The application files must be structured within that project directory.\n"
+    "- Routes should be modular and placed inside a `routes/` directory as separate Python files.\n"
+    "- Templates should be placed in a `templates/` directory.\n"
+    "- Static files (CSS, JS, images) should be placed in a `static/` directory.\n"
+    "- Do not use placeholders like 'Content goes here'. All code should be complete and functional.\n"
+    "- Do not ask the user for additional input; infer any necessary details to complete the application.\n"
+    "- Ensure all routes are properly linked and that templates include necessary CSS and JS files.\n"
+    "- Handle any errors internally and attempt to resolve them before proceeding.\n\n"
+    "Available Tools:\n"
+    "- `create_directory(path)`: Create a new directory.\n"
+    "- `create_file(path, content)`: Create or overwrite a file with content.\n"
+    "- `update_file(path, content)`: Update an existing file with new content.\n"
+    "- `edit_file(path, edits, diff)`: Apply search/replace edits or a unified diff to an existing file without resending all of it.\n"
+    "- `fetch_code(file_path)`: Retrieve the code from a file for review.\n"
+    "- `fetch_files(paths, pattern)`: Retrieve several files at once; files you already have are reported as unchanged.\n"
+    "- `task_completed()`: Call this when the application is fully built and ready.\n\n"
+    "Remember to think carefully at each step, ensuring the application is complete, functional, and meets the user's requirements."
+)
+
+def agent_steps(user_input, project_dir, job, build_log):
+    # The agent loop as a generator of side effects ("completion", "completions", "tools", "validate", "commit",
+    # "rollback", "flush", "checkpoint", "wait").
+    # run_main_loop and run_main_loop_async drive it with blocking and asyncio I/O respectively.
+    job.update_progress(status="running")
+
+    if not supports_function_calling(model_routes["tools"].model):
+        job.emit("Model does not support function calling.")
+        job.update_progress(status="error", completed=True)
         return "Model does not support function calling."
 
-    max_iterations = progress["max_iterations"]
+    max_iterations = job.progress["max_iterations"]
     iteration = 0
 
     messages = [
-        {
-            "role": "system",
-            "content": (
-                "You are an expert Flask developer tasked with building a complete, production-ready Flask application based on the user's description. "
-                "Before coding, carefully plan out all the files, routes, templates, and static assets needed. "
-                f"All files should be created within the project directory: {project_dir}\n"
-                "Follow these steps:\n"
-                "1. **Understand the Requirements**: Analyze the user's input to fully understand the application's functionality and features.\n"
-                "2. **Plan the Application Structure**: List all the routes, templates, and static files that need to be created. Consider how they interact.\n"
-                "3. **Implement Step by Step**: For each component, use the provided tools to create directories, files, and write code. Ensure each step is thoroughly completed before moving on.\n"
-                "4. **Review and Refine**: Use `fetch_code` to review the code you've written. Update files if necessary using `update_file`.\n"
-                "5. **Ensure Completeness**: Do not leave any placeholders or incomplete code. All functions, routes, and templates must be fully implemented and ready for production.\n"
-                "6. **Finalize**: Once everything is complete and thoroughly tested, call `task_completed()` to finish.\n\n"
-                "Constraints and Notes:\n"
-                f"- The application files must be structured within the project directory: {project_dir}\n"
-                "- Routes should be modular and placed inside a `routes/` directory as separate Python files.\n"
-                "- Templates should be placed in a `templates/` directory.\n"
-                "- Static files (CSS, JS, images) should be placed in a `static/` directory.\n"
-                "- Do not use placeholders like 'Content goes here'. All code should be complete and functional.\n"
-                "- Do not ask the user for additional input; infer any necessary details to complete the application.\n"
-                "- Ensure all routes are properly linked and that templates include necessary CSS and JS files.\n"
-                "- Handle any errors internally and attempt to resolve them before proceeding.\n\n"
-                "Available Tools:\n"
-                "- `create_directory(path)`: Create a new directory.\n"
-                "- `create_file(path, content)`: Create or overwrite a file with content.\n"
-                "- `update_file(path, content)`: Update an existing file with new content.\n"
-                "- `fetch_code(file_path)`: Retrieve the code from a file for review.\n"
-                "- `task_completed()`: Call this when the application is fully built and ready.\n\n"
-                "Remember to think carefully at each step, ensuring the application is complete, functional, and meets the user's requirements."
-            )
-        },
-        {"role": "user", "content": user_input},
-        {"role": "system", "content": f"History:\n{json.dumps(history_dict, indent=2)}"}
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "system", "content": f"Project directory: {project_dir}\nUse paths inside this directory for every file and directory you create."},
+        {"role": "user", "content": user_input}
     ]
 
-    output = ""
+    if job.resume:
+        messages = job.resume["messages"]
+        iteration = job.resume["iteration"]
+        job.emit(f"<em>Resumed from checkpoint at iteration {iteration}</em>\n")
+        log_event(build_log, "resume", iteration, from_iteration=iteration)
+    elif job.generation_mode == "fanout":
+        if (yield from fanout_steps(user_input, project_dir, job, build_log, messages)):
+            yield ("commit", None)
+            yield ("flush", None)
+            yield ("checkpoint", (iteration, messages, False))
+
+    consecutive_errors = 0
+    context = ContextManager(job.context_budget)
 
     while iteration < max_iterations:
-        progress["iteration"] = iteration + 1
-        current_iteration = {
-            "iteration": iteration + 1,
-            "actions": [],
-            "llm_responses": [],
-            "tool_results": [],
-            "errors": []
-        }
-        history_dict['iterations'].append(current_iteration)
+        if job.cancelled:
+            job.emit("\n<h2>CANCELLED</h2>\n")
+            job.update_progress(status="cancelled", completed=True)
+            yield ("flush", None)
+            return job.output()
 
+        job.update_progress(iteration=iteration + 1)
+        log_event(build_log, "iteration", iteration + 1)
+        failed = False
+
+        # A failed compaction only means a larger request; it never fails the iteration
+        compacted = False
         try:
-            response = completion(
-                model=MODEL_NAME,
-                messages=messages,
-                tools=tools,
-                tool_choice="auto"
-            )
+            compaction = context.compact(messages)
+        except Exception as e:
+            compaction = None
+            log_event(build_log, "error", iteration + 1, action='compaction', error=str(e), traceback=traceback.format_exc())
+        if compaction:
+            compacted = True
+            # Compacted bodies are no longer in the model's context
+            job.files.forget_delivered()
+            log_event(build_log, "compaction", iteration + 1, **compaction)
+            job.emit(f"<em>Context compacted: {compaction['before']} -> {compaction['after']} tokens ({compaction['saved']} saved)</em>\n")
+            job.update_progress(context_tokens=compaction["after"], tokens_saved=context.tokens_saved)
+        # Compaction edits the list in place; a failed iteration is cut back to what it left
+        message_mark = len(messages)
+
+        try:
+            response = yield ("completion", {
+                "route": "tools",
+                "messages": messages,
+                "tools": tools,
+                "tool_choice": "auto"
+            })
+            account_usage(job, build_log, iteration + 1, "tools", response)
 
             if not response.choices[0].message:
                 error = response.get('error', 'Unknown error')
-                current_iteration['errors'].append({'action': 'llm_completion', 'error': error})
-                log_to_file(history_dict)
-                sleep(5)
+                log_event(build_log, "error", iteration + 1, action='llm_completion', error=error)
+                yield ("flush", None)
+                consecutive_errors += 1
+                yield ("wait", error_backoff(consecutive_errors))
                 iteration += 1
                 continue
 
             response_message = response.choices[0].message
             content = response_message.content or ""
-            current_iteration['llm_responses'].append(content)
+            log_event(build_log, "llm_response", iteration + 1, content=content)
 
-            output += f"\n<h3>Iteration {iteration + 1}:</h3>\n"
+            job.emit(f"\n<h3>Iteration {iteration + 1}:</h3>\n")
 
             tool_calls = response_message.tool_calls
 
             if tool_calls:
-                output += "<strong>Tool Call:</strong>\n<p>" + content + "</p>\n"
-                messages.append(response_message)
-
-                for tool_call in tool_calls:
-                    function_name = tool_call.function.name
-                    function_to_call = available_functions.get(function_name)
-
-                    if not function_to_call:
-                        error_message = f"Tool '{function_name}' is not available."
-                        current_iteration['errors'].append({
-                            'action': f'tool_call_{function_name}',
-                            'error': error_message,
-                            'traceback': 'No traceback available.'
-                        })
-                        continue
+                job.emit("<strong>Tool Call:</strong>\n<p>" + content + "</p>\n")
+                messages.append(message_to_dict(response_message))
 
-                    try:
-                        function_args = json.loads(tool_call.function.arguments)
-
-                        function_response = function_to_call(**function_args)
-
-                        current_iteration['tool_results'].append({
-                            'tool': function_name,
-                            'result': function_response
-                        })
-
-                        output += f"<strong>Tool Result ({function_name}):</strong>\n<p>{function_response}</p>\n"
-
-                        messages.append(
-                            {"tool_call_id": tool_call.id, "role": "tool", "name": function_name, "content": function_response}
-                        )
-
-                        if function_name == "task_completed":
-                            progress["status"] = "completed"
-                            progress["completed"] = True
-                            output += "\n<h2>COMPLETE</h2>\n"
-                            progress["output"] = output
-                            log_to_file(history_dict)
-                            return output
-
-                    except Exception as tool_error:
-                        error_message = f"Error executing {function_name}: {tool_error}"
-                        current_iteration['errors'].append({
-                            'action': f'tool_call_{function_name}',
-                            'error': error_message,
-                            'traceback': traceback.format_exc()
-                        })
-
-                second_response = completion(
-                    model=MODEL_NAME,
-                    messages=messages
-                )
-                if second_response.choices and second_response.choices[0].message:
-                    second_response_message = second_response.choices[0].message
-                    content = second_response_message.content or ""
-                    current_iteration['llm_responses'].append(content)
-                    output += "<strong>LLM Response:</strong>\n<p>" + content + "</p>\n"
-                    messages.append(second_response_message)
-                else:
-                    error = second_response.get('error', 'Unknown error in second LLM response.')
-                    current_iteration['errors'].append({'action': 'second_llm_completion', 'error': error})
+                results = yield ("tools", tool_calls)
+                for result in results:
+                    tool_call = result["tool_call"]
+                    function_name = result["name"]
+
+                    # Every tool call gets an answer, in order; providers reject a request with an unanswered one
+                    if result["error"]:
+                        log_event(build_log, "error", iteration + 1, **result["error"])
+                        function_response = result["error"]["error"]
+                    else:
+                        function_response = result["response"]
+                        log_event(build_log, "tool_result", iteration + 1, tool=function_name, result=function_response)
+
+                    job.emit(f"<strong>Tool Result ({function_name}):</strong>\n<p>{function_response}</p>\n")
+
+                    messages.append(
+                        {"tool_call_id": tool_call.id, "role": "tool", "name": function_name, "content": function_response}
+                    )
+
+                    if function_name == "task_completed":
+                        # A failed commit lands in the handler below like any other failed iteration
+                        yield ("commit", None)
+                        job.emit("\n<h2>COMPLETE</h2>\n")
+                        job.update_progress(status="completed", completed=True)
+                        yield ("flush", None)
+                        return job.output()
+
+                diagnostics = yield ("validate", None)
+                if diagnostics:
+                    log_event(build_log, "validation", iteration + 1, diagnostics=diagnostics)
+                    job.emit(f"<strong>Validation:</strong>\n<p>{diagnostics}</p>\n")
+                    messages.append({"role": "user", "content": diagnostics})
+
+                # In "single" mode the tool results go straight into the next tool-enabled call;
+                # "narrate" keeps the extra tool-less call that only describes what happened.
+                if job.loop_mode == "narrate":
+                    second_response = yield ("completion", {
+                        "route": "narrate",
+                        "messages": messages
+                    })
+                    account_usage(job, build_log, iteration + 1, "narrate", second_response)
+                    if second_response.choices and second_response.choices[0].message:
+                        second_response_message = second_response.choices[0].message
+                        content = second_response_message.content or ""
+                        log_event(build_log, "llm_response", iteration + 1, content=content)
+                        job.emit("<strong>LLM Response:</strong>\n<p>" + content + "</p>\n")
+                        messages.append(message_to_dict(second_response_message))
+                    else:
+                        error = second_response.get('error', 'Unknown error in second LLM response.')
+                        log_event(build_log, "error", iteration + 1, action='second_llm_completion', error=error)
 
             else:
-                output += "<strong>LLM Response:</strong>\n<p>" + content + "</p>\n"
-                messages.append(response_message)
+                job.emit("<strong>LLM Response:</strong>\n<p>" + content + "</p>\n")
+                messages.append(message_to_dict(response_message))
 
-            progress["output"] = output
+            consecutive_errors = 0
 
+        except CacheMiss:
+            raise
         except Exception as e:
             error = str(e)
-            current_iteration['errors'].append({
-                'action': 'main_loop',
-                'error': error,
-                'traceback': traceback.format_exc()
-            })
+            log_event(build_log, "error", iteration + 1, action='main_loop', error=error, traceback=traceback.format_exc())
+            consecutive_errors += 1
+            failed = True
 
         iteration += 1
-        log_to_file(history_dict)
-        sleep(2)
-
-    if iteration >= max_iterations:
-        progress["status"] = "completed"
+        if failed:
+            # Discard the iteration's file writes and the messages that describe them
+            del messages[message_mark:]
+            yield ("rollback", None)
+        else:
+            yield ("commit", None)
+        yield ("flush", None)
+        yield ("checkpoint", (iteration, messages, compacted))
+        if consecutive_errors:
+            yield ("wait", error_backoff(consecutive_errors))
 
-    progress["completed"] = True
-    progress["status"] = "completed"
+    job.update_progress(status="completed", completed=True)
 
-    return output
+    return job.output()
 
 if __name__ == '__main__':
     create_directory(PROJECTS_DIR)
+    if RECOVER_BUILDS:
+        recover_builds()
+    if LLM_WARMUP:
+        preload_backend(warm_tokenizer=True)
     app.run(host='0.0.0.0', port=8080)
\ No newline at end of file
@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# Measures the cold-start cost of the server: importing main.py, serving the first page,
+# and (separately) loading the LLM backend, which is deferred until the first build.
+# Each run is a fresh interpreter, so nothing is shared through sys.modules.
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PROBE = """
+import sys, json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+client = main.app.test_client()
+client.get('/')
+served = time.perf_counter()
+heavy = sorted(name for name in ("litellm", "openai", "tiktoken", "tokenizers", "huggingface_hub", "aiohttp") if name in sys.modules)
+main.llm_backend()
+loaded = time.perf_counter()
+print(json.dumps({
+    "import_seconds": imported - start,
+    "first_request_seconds": served - imported,
+    "backend_load_seconds": loaded - served,
+    "loaded_at_startup": heavy
+}))
+"""
+
+def median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    return ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+
+def parse_importtime(stderr):
+    # Lines look like "import time:  self [us] | cumulative | imported package"
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        parts = line.split(":", 1)[1].split("|")
+        if len(parts) != 3:
+            continue
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append({"name": name.strip(), "depth": depth, "self_us": int(parts[0]), "cumulative_us": int(parts[1])})
+    return modules
+
+def run_probe():
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", PROBE], cwd=BASE_DIR, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1] if process.stderr.strip() else "probe failed")
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    # importtime also reports the backend import; only what happened before "import main" finished counts for startup
+    modules = parse_importtime(process.stderr)
+    main_index = next((index for index, module in enumerate(modules) if module["name"] == "main" and module["depth"] == 0), len(modules) - 1)
+    result["startup_imports"] = [module for module in modules[:main_index + 1] if module["depth"] <= 1]
+    return result
+
+def run_benchmark(runs):
+    samples = [run_probe() for _ in range(runs)]
+    top = {}
+    for sample in samples:
+        for module in sample["startup_imports"]:
+            top.setdefault(module["name"], []).append(module["cumulative_us"] / 1000)
+    return {
+        "runs": runs,
+        "import_seconds": median([sample["import_seconds"] for sample in samples]),
+        "first_request_seconds": median([sample["first_request_seconds"] for sample in samples]),
+        "backend_load_seconds": median([sample["backend_load_seconds"] for sample in samples]),
+        "loaded_at_startup": samples[-1]["loaded_at_startup"],
+        "top_imports_ms": dict(sorted(((name, median(values)) for name, values in top.items()), key=lambda item: -item[1]))
+    }
+
+def print_report(result, top):
+    print(f"\n== startup: median of {result['runs']} runs ==")
+    print(f"import main          {result['import_seconds'] * 1000:10.1f} ms")
+    print(f"first request        {result['first_request_seconds'] * 1000:10.1f} ms")
+    print(f"LLM backend (lazy)   {result['backend_load_seconds'] * 1000:10.1f} ms")
+    if result["loaded_at_startup"]:
+        print(f"WARNING loaded at startup: {', '.join(result['loaded_at_startup'])}")
+    print(f"\nslowest imports during startup (cumulative ms):")
+    for name, ms in list(result["top_imports_ms"].items())[:top]:
+        print(f"  {name:<40} {ms:10.1f}")
+
+def compare(result, baseline, tolerance):
+    regressions = []
+    for key in ("import_seconds", "first_request_seconds"):
+        previous = baseline.get(key)
+        if previous and result[key] > previous * (1 + tolerance):
+            regressions.append(f"{key}: {previous * 1000:.1f} -> {result[key] * 1000:.1f} ms")
+    for name in result["loaded_at_startup"]:
+        if name not in baseline.get("loaded_at_startup", []):
+            regressions.append(f"{name} is now imported at startup")
+    return regressions
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark server startup and the deferred LLM backend import.")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters to measure; the median is reported.")
+    parser.add_argument("--top", type=int, default=15, help="Number of slowest startup imports to list.")
+    parser.add_argument("--json", help="Write the results as JSON to this file.")
+    parser.add_argument("--baseline", help="Compare against a previous --json output and fail on regressions.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative slowdown against the baseline.")
+    args = parser.parse_args(argv)
+
+    result = run_benchmark(args.runs)
+    print_report(result, args.top)
+
+    if args.json:
+        with open(args.json, 'w') as output_file:
+            json.dump(result, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            regressions = compare(result, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main_cli())